@@ -0,0 +1,341 @@
+"""
+Benchmark the build against synthetic TIL repositories with real git
+history, including renames and edits, rendering Markdown through a local
+stand-in for the GitHub Markdown API:
+
+    python benchmarks/build.py 1000 10000 100000
+    python benchmarks/build.py 1000 --json results.json
+    python benchmarks/build.py 1000 --compare results.json
+
+Each stage runs in its own process so peak memory can be measured. The
+corpus is generated from a fixed seed, so runs on the same machine are
+comparable - use --json and --compare to spot regressions.
+
+Options:
+    --api-latency MS   Delay each stand-in API response by MS milliseconds
+    --screenshots      Also time generate_screenshots.py (needs Playwright)
+    --keep             Keep the generated repositories and print their paths
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import html
+import json
+import os
+import pathlib
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root = pathlib.Path(__file__).parent.parent.resolve()
+
+TOPICS = 150
+FILES_PER_COMMIT = 50
+RENAME_FRACTION = 0.05
+EDIT_FRACTION = 0.1
+# Edited and committed between the warm build and the incremental build
+INCREMENTAL_FRACTION = 0.01
+WORDS = (
+    "sqlite python datasette query index table column git commit branch "
+    "render markdown template plugin cache build deploy server request "
+    "response header json async await function class module package test "
+    "fixture docker image container bucket upload stream parse token html"
+).split()
+README = """# TIL
+
+<!-- count starts -->0<!-- count ends -->
+
+<!-- index starts -->
+<!-- index ends -->
+"""
+
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def synthetic_markdown(rng, title):
+    parts = ["# {}".format(title), ""]
+    for _ in range(rng.randint(2, 6)):
+        parts.append(" ".join(sentence(rng) for _ in range(rng.randint(2, 5))))
+        parts.append("")
+        if rng.random() < 0.4:
+            parts.extend(["```python", "def f(x):", "    return x * 2", "```", ""])
+        if rng.random() < 0.2:
+            parts.extend(["- " + sentence(rng, 5) for _ in range(3)] + [""])
+    return "\n".join(parts)
+
+
+def fast_import_stream(size, seed):
+    """
+    Yields a git fast-import stream: commits adding size files, then
+    commits renaming and editing some of them
+    """
+    rng = random.Random(seed)
+    timestamp = 1588000000
+    paths = []
+    for i in range(size):
+        topic = "topic{}".format(i % TOPICS)
+        paths.append("{}/til-{}.md".format(topic, i))
+    commits = []
+    for start in range(0, size, FILES_PER_COMMIT):
+        commits.append(
+            [
+                ("M", path, synthetic_markdown(rng, "TIL number {}".format(i)))
+                for i, path in enumerate(paths[start : start + FILES_PER_COMMIT], start)
+            ]
+        )
+    renamed = rng.sample(range(size), int(size * RENAME_FRACTION))
+    operations = []
+    for i in renamed:
+        new_path = "topic{}/renamed-til-{}.md".format(rng.randrange(TOPICS), i)
+        operations.append(("R", paths[i], new_path))
+        paths[i] = new_path
+    for i in rng.sample(range(size), int(size * EDIT_FRACTION)):
+        operations.append(
+            ("M", paths[i], synthetic_markdown(rng, "TIL number {} (edited)".format(i)))
+        )
+    for start in range(0, len(operations), FILES_PER_COMMIT):
+        commits.append(operations[start : start + FILES_PER_COMMIT])
+    commits.append([("M", "README.md", README)])
+    for mark, operations in enumerate(commits, 1):
+        timestamp += 3600 * rng.randint(1, 48)
+        message = "Commit {}".format(mark).encode("utf-8")
+        yield "commit refs/heads/main\nmark :{}\n".format(mark).encode("utf-8")
+        yield "committer TIL <til@example.com> {} +0000\n".format(timestamp).encode(
+            "utf-8"
+        )
+        yield b"data %d\n%s\n" % (len(message), message)
+        if mark > 1:
+            yield "from :{}\n".format(mark - 1).encode("utf-8")
+        for operation in operations:
+            if operation[0] == "R":
+                yield "R {} {}\n".format(operation[1], operation[2]).encode("utf-8")
+            else:
+                content = operation[2].encode("utf-8")
+                yield "M 100644 inline {}\n".format(operation[1]).encode("utf-8")
+                yield b"data %d\n%s\n" % (len(content), content)
+        yield b"\n"
+
+
+def create_repo(directory, size, seed=0):
+    subprocess.run(["git", "init", "-q", "-b", "main", str(directory)], check=True)
+    proc = subprocess.Popen(
+        ["git", "fast-import", "--quiet"], cwd=directory, stdin=subprocess.PIPE
+    )
+    for chunk in fast_import_stream(size, seed):
+        proc.stdin.write(chunk)
+    proc.stdin.close()
+    assert proc.wait() == 0, "git fast-import failed"
+    subprocess.run(["git", "checkout", "-q", "-f", "main"], cwd=directory, check=True)
+    # Pages and screenshots need the site's templates and plugins
+    for name in ("templates", "plugins", "static", "metadata.yaml"):
+        (directory / name).symlink_to(root / name)
+
+
+def edit_and_commit(directory, fraction, seed=1):
+    rng = random.Random(seed)
+    files = sorted(directory.glob("*/*.md"))
+    for path in rng.sample(files, max(1, int(len(files) * fraction))):
+        path.write_text(path.read_text() + "\n" + sentence(rng) + "\n")
+    subprocess.run(
+        ["git", "-c", "user.name=TIL", "-c", "user.email=til@example.com"]
+        + ["commit", "-q", "-am", "Edits"],
+        cwd=directory,
+        check=True,
+    )
+
+
+class MarkdownHandler(BaseHTTPRequestHandler):
+    "Stands in for POST https://api.github.com/markdown"
+
+    latency = 0
+
+    def do_POST(self):
+        text = json.loads(self.rfile.read(int(self.headers["content-length"])))["text"]
+        if self.latency:
+            time.sleep(self.latency / 1000)
+        body = "\n".join(
+            "<p>{}</p>".format(html.escape(block))
+            for block in text.split("\n\n")
+            if block.strip()
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "text/html;charset=utf-8")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_markdown_server(latency):
+    MarkdownHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MarkdownHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/markdown".format(server.server_address[1])
+
+
+def stage_database(repo):
+    import build_database
+
+    build_database.build_database(repo)
+
+
+def stage_similarities(repo):
+    import build_similarities
+    import sqlite_utils
+
+    build_similarities.build_similarities(sqlite_utils.Database(repo / "tils.db"))
+
+
+def stage_readme(repo):
+    import sqlite_utils
+    import update_readme
+
+    update_readme.rewrite_readme(
+        sqlite_utils.Database(repo / "tils.db"), repo / "README.md"
+    )
+
+
+def stage_screenshots(repo):
+    import generate_screenshots
+
+    generate_screenshots.generate_screenshots(repo)
+
+
+STAGES = {
+    "database": stage_database,
+    "similarities": stage_similarities,
+    "readme": stage_readme,
+    "screenshots": stage_screenshots,
+}
+
+
+def run_stage_in_process(stage, repo):
+    "The child side of run_stage()"
+    sys.path.insert(0, str(root))
+    import instrument
+
+    repo = pathlib.Path(repo)
+    with instrument.build_run(stage, repo / "tils.db"):
+        STAGES[stage](repo)
+
+
+def run_stage(stage, repo, env):
+    """
+    Runs a stage in a child process, returning wall time, peak memory and
+    the counters recorded by instrument.py
+    """
+    events_json = repo / ".cache" / "events.json"
+    events_json.parent.mkdir(exist_ok=True)
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, __file__, "--stage", stage, str(repo)],
+        cwd=repo,
+        env=dict(env, BUILD_EVENTS_JSON=str(events_json)),
+        stdout=subprocess.DEVNULL,
+    )
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    assert proc.returncode == 0, "{} stage failed".format(stage)
+    counters = json.loads(events_json.read_text())["counters"]
+    return {
+        "wall_s": round(wall, 3),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_mb": round(rusage.ru_maxrss / 1024, 1),
+        "subprocesses": counters.get("subprocesses", 0),
+        "api_requests": counters.get("markdown_api.requests", 0),
+        "db_mb": round((repo / "tils.db").stat().st_size / 1024 / 1024, 1),
+    }
+
+
+def benchmark(size, api_latency=0, screenshots=False, keep=False):
+    tmp = pathlib.Path(tempfile.mkdtemp(prefix="til-bench-"))
+    repo = tmp / "til"
+    server, url = start_markdown_server(api_latency)
+    env = dict(
+        os.environ,
+        MARKDOWN_API_URL=url,
+        MARKDOWN_BACKEND="github",
+        MARKDOWN_GITHUB_TOKEN="",
+        SCREENSHOT_STORAGE_DIR=str(tmp / "shots"),
+    )
+    results = {}
+    try:
+        start = time.perf_counter()
+        create_repo(repo, size)
+        results["create_repo"] = {"wall_s": round(time.perf_counter() - start, 3)}
+        results["database (cold)"] = run_stage("database", repo, env)
+        results["database (no changes)"] = run_stage("database", repo, env)
+        edit_and_commit(repo, INCREMENTAL_FRACTION)
+        results["database (1% edited)"] = run_stage("database", repo, env)
+        results["similarities"] = run_stage("similarities", repo, env)
+        results["readme"] = run_stage("readme", repo, env)
+        if screenshots:
+            results["screenshots"] = run_stage("screenshots", repo, env)
+    finally:
+        server.shutdown()
+        if keep:
+            print("Kept {}".format(repo))
+        else:
+            shutil.rmtree(tmp)
+    return results
+
+
+COLUMNS = ("wall_s", "peak_mb", "subprocesses", "api_requests", "db_mb")
+
+
+def print_results(size, results, baseline=None):
+    print("{} files".format(size))
+    print("  {:<24}".format("stage") + "".join("{:>16}".format(c) for c in COLUMNS))
+    for stage, values in results.items():
+        row = "  {:<24}".format(stage)
+        for column in COLUMNS:
+            value = values.get(column)
+            cell = "" if value is None else str(value)
+            previous = (baseline or {}).get(stage, {}).get(column)
+            if value is not None and previous:
+                cell += " ({:+.0f}%)".format(100 * (value - previous) / previous)
+            row += "{:>16}".format(cell)
+        print(row)
+
+
+def main(args):
+    if args[:1] == ["--stage"]:
+        run_stage_in_process(args[1], args[2])
+        return
+    options = {}
+    for flag in ("--json", "--compare", "--api-latency"):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i : i + 2]
+    screenshots = "--screenshots" in args
+    keep = "--keep" in args
+    sizes = [int(arg) for arg in args if not arg.startswith("--")] or [1000]
+    baseline = {}
+    if "--compare" in options:
+        baseline = json.loads(pathlib.Path(options["--compare"]).read_text())
+    all_results = {}
+    for size in sizes:
+        results = benchmark(
+            size,
+            api_latency=float(options.get("--api-latency", 0)),
+            screenshots=screenshots,
+            keep=keep,
+        )
+        all_results[str(size)] = results
+        print_results(size, results, baseline.get(str(size)))
+    if "--json" in options:
+        pathlib.Path(options["--json"]).write_text(json.dumps(all_results, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,342 @@
+"""
+Load test the site in-process: Datasette with metadata.yaml, plugins/ and
+templates/, serving tils.db as an immutable database like the deployed
+site, driven by concurrent requests through its ASGI app.
+
+    python benchmarks/load.py
+    python benchmarks/load.py --synthetic 10000 --concurrency 50
+    python benchmarks/load.py --json baseline.json
+    python benchmarks/load.py --compare baseline.json
+
+Requests are drawn from a weighted mix of routes (see ROUTE_MIX) using a
+fixed seed, so runs against the same database are comparable. Reports
+throughput plus p50/p95/p99 latency per route.
+
+Options:
+    --db PATH          Database to serve (default: tils.db in the repo root)
+    --synthetic N      Generate and serve a synthetic database of N TILs
+    --requests N       Total requests to send (default 2000)
+    --concurrency N    Requests in flight at once (default 20)
+    --cache            Keep the response and query caches in plugins/ on -
+                       they are off by default, so pages are really rendered
+    --json PATH        Write the results to PATH, for use with --compare
+    --compare PATH     Show the change from the results in PATH
+"""
+
+import asyncio
+import json
+import os
+import pathlib
+import random
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+import yaml
+
+root = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(root))
+
+SEED = 0
+WARMUP_REQUESTS = 50
+# (route, weight) - roughly the shape of real traffic, which is mostly
+# individual TILs arriving from search engines and links
+ROUTE_MIX = (
+    ("/{topic}/{slug}", 50),
+    ("/", 12),
+    ("/{topic}", 12),
+    ("/tils/search", 10),
+    ("/all", 4),
+    ("/tils/feed.atom", 6),
+    ("/tils/feed_by_topic.atom", 4),
+    ("/{topic}/{slug} (moved)", 2),
+)
+# Code-like queries exercise the trigram index as well as the porter one
+CODE_QUERIES = ("--help", "pip install", "select *", ".json", "os.environ", "__init__")
+
+
+def synthetic_database(path, size, seed=SEED):
+    "Writes a tils.db of size TILs, built with the same helpers as the real one"
+    import build_database
+    import build_similarities
+    import markdown_render
+    import sqlite_utils
+
+    sys.path.insert(0, str(root / "benchmarks"))
+    from build import TOPICS, synthetic_markdown
+
+    rng = random.Random(seed)
+    rows = []
+    bodies = {}
+    for i in range(size):
+        topic = "topic{}".format(i % TOPICS)
+        slug = "til-{}".format(i)
+        markdown = synthetic_markdown(rng, "TIL number {}".format(i))
+        title, _, body = markdown.partition("\n")
+        created = "2020-{:02d}-{:02d}T12:00:00-07:00".format(1 + i % 12, 1 + i % 28)
+        times = build_database.file_times_from_dates(created, created)
+        path_slug = "{}_{}.md".format(topic, slug)
+        bodies[path_slug] = body.strip()
+        rows.append(
+            dict(
+                {
+                    "path": path_slug,
+                    "slug": slug,
+                    "topic": topic,
+                    "title": title.lstrip("#").strip(),
+                    "url": "https://github.com/simonw/til/blob/main/{}/{}.md".format(
+                        topic, slug
+                    ),
+                    "body": bodies[path_slug],
+                },
+                **times
+            )
+        )
+    rendered = markdown_render.LocalBackend().render_batch(bodies)
+    for row in rows:
+        row["html"] = rendered[row["path"]]
+        (
+            row["first_paragraph_html"],
+            row["summary"],
+        ) = build_database.first_paragraph_html_and_text(row["html"])
+    db = sqlite_utils.Database(path)
+    table = db.table("til", pk="path")
+    table.insert_all(rows, pk="path")
+    build_database.ensure_indexes(table)
+    build_database.update_topics(db)
+    build_database.ensure_fts(db, table)
+    build_database.ensure_trigram_fts(db, table)
+    build_database.update_redirects(
+        db,
+        [
+            (
+                "old-topic/{}.md".format(row["slug"]),
+                "{}/{}.md".format(row["topic"], row["slug"]),
+            )
+            for row in rows[: size // 20]
+        ],
+        [],
+    )
+    build_similarities.build_similarities(db)
+
+
+def route_paths(db_path):
+    "Candidate request paths for each route in ROUTE_MIX"
+    import sqlite_utils
+
+    db = sqlite_utils.Database(db_path)
+    tils = [(row["topic"], row["slug"], row["title"]) for row in db["til"].rows]
+    topics = sorted({topic for topic, _, _ in tils})
+    words = sorted(
+        {
+            word.lower()
+            for _, _, title in tils
+            for word in title.split()
+            if len(word) > 3
+        }
+    )
+    moved = []
+    if db["redirects"].exists():
+        moved = [row["from_path"] for row in db["redirects"].rows]
+    return {
+        "/{topic}/{slug}": ["/{}/{}".format(topic, slug) for topic, slug, _ in tils],
+        "/": ["/"],
+        "/{topic}": ["/{}".format(topic) for topic in topics],
+        "/tils/search": [
+            "/tils/search?" + urllib.parse.urlencode({"q": q})
+            for q in words + list(CODE_QUERIES)
+        ],
+        "/all": ["/all"],
+        "/tils/feed.atom": ["/tils/feed.atom"],
+        "/tils/feed_by_topic.atom": [
+            "/tils/feed_by_topic.atom?" + urllib.parse.urlencode({"topic": topic})
+            for topic in topics
+        ],
+        "/{topic}/{slug} (moved)": moved,
+    }
+
+
+def request_plan(paths, count, seed=SEED):
+    "count (route, path) pairs drawn from ROUTE_MIX"
+    rng = random.Random(seed)
+    mix = [(route, weight) for route, weight in ROUTE_MIX if paths.get(route)]
+    routes = rng.choices(
+        [route for route, _ in mix], [weight for _, weight in mix], k=count
+    )
+    # Popular pages get more traffic than the long tail
+    return [
+        (
+            route,
+            paths[route][
+                (
+                    min(int(rng.paretovariate(1.2)) - 1, len(paths[route]) - 1)
+                    if route == "/{topic}/{slug}"
+                    else rng.randrange(len(paths[route]))
+                )
+            ],
+        )
+        for route in routes
+    ]
+
+
+def disable_caches():
+    "Read by plugins/ when Datasette loads them, so call this first"
+    os.environ["TIL_RESPONSE_CACHE_BYTES"] = "0"
+    os.environ["TIL_QUERY_CACHE_SIZE"] = "0"
+
+
+def make_datasette(db_path):
+    from datasette.app import Database, Datasette
+
+    datasette = Datasette(
+        [],
+        metadata=yaml.safe_load((root / "metadata.yaml").read_text()),
+        plugins_dir=str(root / "plugins"),
+        template_dir=str(root / "templates"),
+        static_mounts=[("static", str(root / "static"))],
+    )
+    datasette.add_database(
+        Database(datasette, path=str(db_path), is_mutable=False), name="tils"
+    )
+    return datasette
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+async def run_load(datasette, plan, concurrency):
+    "Returns ({route: [latency_ms]}, {route: {status: count}}, wall seconds)"
+    latencies = {}
+    statuses = {}
+    queue = iter(plan)
+
+    async def worker():
+        for route, path in queue:
+            start = time.perf_counter()
+            response = await datasette.client.get(path)
+            ms = (time.perf_counter() - start) * 1000
+            latencies.setdefault(route, []).append(ms)
+            route_statuses = statuses.setdefault(route, {})
+            status = str(response.status_code)
+            route_statuses[status] = route_statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - start
+
+
+def summarize(latencies, statuses, wall):
+    results = {}
+    for route, values in list(latencies.items()) + [
+        ("all", [ms for values in latencies.values() for ms in values])
+    ]:
+        values = sorted(values)
+        results[route] = {
+            "requests": len(values),
+            "rps": round(len(values) / wall, 1),
+            "p50_ms": round(percentile(values, 0.5), 2),
+            "p95_ms": round(percentile(values, 0.95), 2),
+            "p99_ms": round(percentile(values, 0.99), 2),
+            "max_ms": round(values[-1], 2),
+            "statuses": statuses.get(route)
+            or {
+                status: sum(s.get(status, 0) for s in statuses.values())
+                for status in sorted({s for v in statuses.values() for s in v})
+            },
+        }
+    return results
+
+
+COLUMNS = ("requests", "rps", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+
+
+def print_results(results, baseline=None):
+    print("{:<28}".format("route") + "".join("{:>16}".format(c) for c in COLUMNS))
+    for route in sorted(results, key=lambda route: (route == "all", route)):
+        values = results[route]
+        row = "{:<28}".format(route)
+        for column in COLUMNS:
+            cell = str(values[column])
+            previous = (baseline or {}).get(route, {}).get(column)
+            if column != "requests" and previous:
+                cell += " ({:+.0f}%)".format(
+                    100 * (values[column] - previous) / previous
+                )
+            row += "{:>16}".format(cell)
+        print(row)
+    for route, values in sorted(results.items()):
+        errors = {
+            status: count
+            for status, count in values["statuses"].items()
+            if not status.startswith(("2", "3"))
+        }
+        if errors and route != "all":
+            print("  {}: {}".format(route, errors))
+
+
+async def main(args):
+    options = {}
+    for flag in (
+        "--db",
+        "--synthetic",
+        "--requests",
+        "--concurrency",
+        "--json",
+        "--compare",
+    ):
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i : i + 2]
+    if "--cache" not in args:
+        disable_caches()
+    tmp = None
+    try:
+        if "--synthetic" in options:
+            tmp = pathlib.Path(tempfile.mkdtemp(prefix="til-load-"))
+            db_path = tmp / "tils.db"
+            start = time.perf_counter()
+            synthetic_database(db_path, int(options["--synthetic"]))
+            print(
+                "Generated {} TILs in {:.1f}s".format(
+                    options["--synthetic"], time.perf_counter() - start
+                )
+            )
+        else:
+            db_path = pathlib.Path(options.get("--db") or root / "tils.db")
+        datasette = make_datasette(db_path)
+        await datasette.invoke_startup()
+        paths = route_paths(db_path)
+        requests = int(options.get("--requests", 2000))
+        concurrency = int(options.get("--concurrency", 20))
+        # Warm up templates, connections and the page caches
+        await run_load(
+            datasette, request_plan(paths, WARMUP_REQUESTS, seed=SEED + 1), concurrency
+        )
+        latencies, statuses, wall = await run_load(
+            datasette, request_plan(paths, requests), concurrency
+        )
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+    results = summarize(latencies, statuses, wall)
+    print(
+        "{} requests, concurrency {}, {:.2f}s, {:.1f} requests/second\n".format(
+            requests, concurrency, wall, requests / wall
+        )
+    )
+    baseline = None
+    if "--compare" in options:
+        baseline = json.loads(pathlib.Path(options["--compare"]).read_text())
+    print_results(results, baseline)
+    if "--json" in options:
+        pathlib.Path(options["--json"]).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
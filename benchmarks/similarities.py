@@ -0,0 +1,71 @@
+"""
+Time build_similarities.py against a synthetic corpus - vectorizing, a full
+top-k calculation and an incremental update after a handful of edits.
+
+    python benchmarks/similarities.py 1000 10000 50000
+"""
+
+import numpy as np
+import pathlib
+import sqlite_utils
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import build_similarities  # noqa: E402
+
+WORDS_PER_DOCUMENT = 300
+VOCABULARY_SIZE = 30000
+TOPICS = 100
+
+
+def synthetic_tils(count, seed=0):
+    "Documents drawn from a Zipf distribution, with topic-specific words mixed in"
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(["w{}".format(i) for i in range(VOCABULARY_SIZE)])
+    for i in range(count):
+        topic = i % TOPICS
+        general = rng.zipf(1.3, WORDS_PER_DOCUMENT) % VOCABULARY_SIZE
+        topical = (topic * 50 + rng.integers(0, 50, WORDS_PER_DOCUMENT // 5)) % (
+            VOCABULARY_SIZE
+        )
+        words = vocabulary[np.concatenate([general, topical])]
+        yield {
+            "path": "topic{}_til{}.md".format(topic, i),
+            "title": " ".join(words[:6]),
+            "body": " ".join(words[6:]),
+        }
+
+
+def timed(label, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    print("  {:<32} {:>8.2f}s".format(label, time.perf_counter() - start))
+    return result
+
+
+def main(sizes):
+    for size in sizes:
+        print("{} documents".format(size))
+        db = sqlite_utils.Database(memory=True)
+        db["til"].insert_all(synthetic_tils(size), pk="path")
+        rows = list(db.query("select path, title, body from til order by path"))
+        texts = [build_similarities.document_text(row) for row in rows]
+        matrix = timed("vectorize", build_similarities.vectorize, texts)
+        print("  {:<32} {:>9}".format("matrix shape", "x".join(map(str, matrix.shape))))
+        timed(
+            "top {} for 1,000 documents".format(build_similarities.TOP_K),
+            lambda: list(
+                build_similarities.top_k(matrix, list(range(min(size, 1000))))
+            ),
+        )
+        timed("full build", build_similarities.build_similarities, db)
+        # Edit ten documents and recalculate
+        for row in rows[:10]:
+            db["til"].update(row["path"], {"body": row["body"] + " edited w1 w2 w3"})
+        timed("incremental, 10 edited", build_similarities.build_similarities, db)
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 50000])
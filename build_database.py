@@ -1,38 +1,58 @@
 from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
-import httpx
+import instrument
+import markdown_render
 import os
 import pathlib
+import sqlite3
 import subprocess
-from urllib.parse import urlencode
+import sys
 import sqlite_utils
 from sqlite_utils.db import NotFoundError
 import time
 
 root = pathlib.Path(__file__).parent.resolve()
 
+# Processes used to read files and extract summaries from rendered HTML
+WORKERS = int(os.environ.get("BUILD_WORKERS") or os.cpu_count() or 1)
+# Files per task sent to a worker
+CHUNK_SIZE = 200
+# Chunks in flight ahead of the writer, per worker - this bounds memory use
+QUEUE_CHUNKS_PER_WORKER = 2
 
-def first_paragraph_text_only(html):
-    soup = BeautifulSoup(html, "html.parser")
-    return " ".join(soup.find("p").stripped_strings)
 
+def first_paragraph_html_and_text(html):
+    "Returns the HTML and the text of the first paragraph, from a single parse"
+    paragraph = BeautifulSoup(html, "html.parser").find("p")
+    if paragraph is None:
+        return "", ""
+    return str(paragraph), " ".join(paragraph.stripped_strings)
 
-def get_file_times(repo_path, filepath):
-    """Get created and updated times for a file, following renames."""
-    # Get all commit dates for this file, following renames
-    # First line is most recent (updated), last line is oldest (created)
-    result = subprocess.run(
-        ["git", "log", "--follow", "--format=%cI", "--", filepath],
-        cwd=repo_path,
-        capture_output=True,
-        text=True,
-    )
-    output = result.stdout.strip()
-    if not output:
-        return None
-    dates = output.split("\n")
-    updated_dt = datetime.fromisoformat(dates[0])
-    created_dt = datetime.fromisoformat(dates[-1])
+
+def backfill_first_paragraphs(db, table):
+    "Populate first_paragraph_html for rows written before that column existed"
+    if "first_paragraph_html" not in table.columns_dict:
+        table.add_column("first_paragraph_html", str)
+    rows = db.execute(
+        "select path, html from til where first_paragraph_html is null"
+    ).fetchall()
+    if rows:
+        with db.atomic():
+            db.conn.executemany(
+                "update til set first_paragraph_html = ? where path = ?",
+                [
+                    (first_paragraph_html_and_text(html or "")[0], path)
+                    for path, html in rows
+                ],
+            )
+        print("Added first_paragraph_html to {} rows".format(len(rows)))
+
+
+def file_times_from_dates(created, updated):
+    created_dt = datetime.fromisoformat(created)
+    updated_dt = datetime.fromisoformat(updated)
     return {
         "created": created_dt.isoformat(),
         "created_utc": created_dt.astimezone(timezone.utc).isoformat(),
@@ -41,83 +61,677 @@ def get_file_times(repo_path, filepath):
     }
 
 
-def build_database(repo_path):
+def git(repo_path, *args):
+    instrument.count("subprocesses")
+    return subprocess.run(["git", *args], cwd=repo_path, capture_output=True, text=True)
+
+
+def walk_git_history(repo_path, index, since=None, renames=None):
+    """
+    Walk commits oldest-first in a single git log call, following renames,
+    updating index (a dict of path -> [created, updated]) in place. Renames
+    are appended to renames as (old_path, new_path), if it is provided.
+    """
+    revision = "{}..HEAD".format(since) if since else "HEAD"
+    result = git(
+        repo_path,
+        "log",
+        "-z",
+        "--reverse",
+        "-M",
+        "--name-status",
+        "--format=%x01%cI",
+        revision,
+        "--",
+        "*.md",
+    )
+    for commit in result.stdout.split("\x01")[1:]:
+        date, _, changes = commit.partition("\0")
+        tokens = changes.lstrip("\n").split("\0")
+        i = 0
+        while i < len(tokens) and tokens[i]:
+            status = tokens[i][0]
+            if status in "RC":
+                old_path, new_path = tokens[i + 1], tokens[i + 2]
+                i += 3
+                if status == "R":
+                    # Renames carry the created date across, like --follow
+                    created = index.pop(old_path, [date, date])[0]
+                    if renames is not None:
+                        renames.append((old_path, new_path))
+                else:
+                    created = date
+                index[new_path] = [created, date]
+            else:
+                path = tokens[i + 1]
+                i += 2
+                if status == "D":
+                    index.pop(path, None)
+                elif status == "A" or path not in index:
+                    index[path] = [date, date]
+                else:
+                    index[path][1] = date
+
+
+def url_path(path):
+    "/{topic}/{slug} for a topic/slug.md file, None for any other path"
+    topic, _, filename = path.partition("/")
+    if not filename or "/" in filename or not filename.endswith(".md"):
+        return None
+    return "/{}/{}".format(topic, filename[: -len(".md")])
+
+
+def update_redirects(db, renames, current_paths):
+    """
+    Apply renames, in commit order, to the redirects table - which maps every
+    old /{topic}/{slug} to where that TIL lives now. Chains are collapsed, so
+    a TIL moved twice redirects from both old URLs straight to the new one.
+    """
+    redirects = db.table("redirects")
+    redirects.create(
+        {"from_path": str, "to_path": str}, pk="from_path", if_not_exists=True
+    )
+    redirects.create_index(["to_path"], if_not_exists=True)
+    for old_path, new_path in renames:
+        old_url, new_url = url_path(old_path), url_path(new_path)
+        if old_url is None or new_url is None or old_url == new_url:
+            continue
+        db.execute(
+            "update redirects set to_path = ? where to_path = ?", [new_url, old_url]
+        )
+        db.execute(
+            "insert or replace into redirects (from_path, to_path) values (?, ?)",
+            [old_url, new_url],
+        )
+        # Moved back to a URL it used to have
+        db.execute("delete from redirects where from_path = ?", [new_url])
+    # A new TIL created at an old URL takes it back
+    db.conn.executemany(
+        "delete from redirects where from_path = ?",
+        [(url,) for url in map(url_path, current_paths) if url],
+    )
+
+
+def get_file_times_index(db, repo_path):
+    """
+    Returns {path: file_times} for every Markdown file in the repo, using a
+    path -> (created, updated) index cached in the git_file_times table and
+    keyed by the HEAD commit it was built from. The redirects table is kept
+    up to date from the same walk.
+    """
+    head = git(repo_path, "rev-parse", "HEAD").stdout.strip()
+    if not head:
+        return {}
+    state = db.table("build_state", pk="key")
+    times_table = db.table("git_file_times", pk="path")
+    try:
+        indexed_head = state.get("git_file_times_head")["value"]
+    except NotFoundError:
+        indexed_head = None
+    if indexed_head != head or not db.table("redirects").exists():
+        since = None
+        if indexed_head and times_table.exists() and db.table("redirects").exists():
+            is_ancestor = git(
+                repo_path, "merge-base", "--is-ancestor", indexed_head, head
+            )
+            if is_ancestor.returncode == 0:
+                since = indexed_head
+        index = {}
+        if since:
+            index = {
+                row["path"]: [row["created"], row["updated"]]
+                for row in times_table.rows
+            }
+        previous = {path: tuple(dates) for path, dates in index.items()}
+        renames = []
+        walk_git_history(repo_path, index, since=since, renames=renames)
+        changed = [
+            {"path": path, "created": created, "updated": updated}
+            for path, (created, updated) in index.items()
+            if previous.get(path) != (created, updated)
+        ]
+        removed = [path for path in previous if path not in index]
+        with db.atomic():
+            if not since and times_table.exists():
+                times_table.delete_where()
+            if not since and db.table("redirects").exists():
+                db.table("redirects").delete_where()
+            times_table.upsert_all(changed, pk="path")
+            for path in removed:
+                times_table.delete(path)
+            update_redirects(db, renames, index)
+            state.upsert({"key": "git_file_times_head", "value": head}, pk="key")
+        print(
+            "Indexed git history {} to {}: {} changed, {} removed, {} renamed".format(
+                "from {}".format(since[:7]) if since else "from scratch",
+                head[:7],
+                len(changed),
+                len(removed),
+                len(renames),
+            )
+        )
+    if not times_table.exists():
+        return {}
+    return {
+        row["path"]: file_times_from_dates(row["created"], row["updated"])
+        for row in times_table.rows
+    }
+
+
+def get_file_fingerprints(repo_path):
+    """
+    Returns {path: fingerprint} for every */*.md file without reading them:
+    the git blob SHA for committed files, size and mtime for anything that
+    has been modified or is not yet tracked
+    """
+    fingerprints = {}
+    listing = git(repo_path, "ls-files", "-z", "-s", "--", "*/*.md")
+    dirty = git(
+        repo_path, "ls-files", "-z", "-m", "-o", "--exclude-standard", "--", "*/*.md"
+    )
+    if listing.returncode == 0 and dirty.returncode == 0:
+        for line in listing.stdout.split("\0"):
+            if line:
+                info, _, path = line.partition("\t")
+                fingerprints[path] = "blob:" + info.split()[1]
+        dirty_paths = set(filter(None, dirty.stdout.split("\0")))
+    else:
+        # Not a git checkout - fall back to size and mtime for everything
+        dirty_paths = {
+            str(filepath.relative_to(repo_path))
+            for filepath in repo_path.glob("*/*.md")
+        }
+    for path in dirty_paths:
+        filepath = repo_path / path
+        if filepath.exists():
+            stat = filepath.stat()
+            fingerprints[path] = "stat:{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        else:
+            # Deleted but not yet committed
+            fingerprints.pop(path, None)
+    # Match root.glob("*/*.md") - files directly inside a topic directory
+    return {
+        path: fingerprint
+        for path, fingerprint in fingerprints.items()
+        if path.count("/") == 1 and path.endswith(".md")
+    }
+
+
+# Indexes used by the templates and canned queries - the (topic, created_utc)
+# one covers everything /all needs
+TIL_INDEXES = (
+    ["topic", "created_utc", "slug", "title", "created"],
+    ["created_utc"],
+)
+
+
+def ensure_indexes(table):
+    for columns in TIL_INDEXES:
+        table.create_index(
+            columns,
+            index_name="idx_til_{}".format("_".join(columns)),
+            if_not_exists=True,
+        )
+
+
+def update_topics(db):
+    "Rebuild the topics summary table used by the / and /all pages"
+    with db.atomic():
+        db.execute("drop table if exists topics")
+        db.execute("""
+            create table topics (
+                topic text primary key,
+                num_tils integer,
+                latest_created_utc text,
+                sort_order integer
+            )
+            """)
+        db.execute("""
+            insert into topics (topic, num_tils, latest_created_utc, sort_order)
+            select
+                topic,
+                count(*),
+                max(created_utc),
+                row_number() over (order by max(created_utc) desc, topic)
+            from til
+            group by topic
+            """)
+
+
+FTS_COLUMNS = ["title", "body"]
+# Run a full FTS optimize after this many builds that changed rows
+FTS_OPTIMIZE_EVERY = 25
+
+TRIGRAM_SQL = """
+create virtual table [{table}_trigram] using fts5(
+    {columns},
+    tokenize='trigram',
+    content=[{table}]
+);
+create trigger [{table}_trigram_ai] after insert on [{table}] begin
+  insert into [{table}_trigram] (rowid, {columns}) values (new.rowid, {new_columns});
+end;
+create trigger [{table}_trigram_ad] after delete on [{table}] begin
+  insert into [{table}_trigram] ([{table}_trigram], rowid, {columns})
+    values ('delete', old.rowid, {old_columns});
+end;
+create trigger [{table}_trigram_au] after update on [{table}] begin
+  insert into [{table}_trigram] ([{table}_trigram], rowid, {columns})
+    values ('delete', old.rowid, {old_columns});
+  insert into [{table}_trigram] (rowid, {columns}) values (new.rowid, {new_columns});
+end;
+insert into [{table}_trigram] ([{table}_trigram]) values ('rebuild');
+"""
+
+
+def ensure_fts(db, table):
+    """
+    Configure til_fts and its triggers if they are missing or out of date.
+    Once set up the triggers keep the index in sync, so this is a no-op.
+    """
+    fts_table = db.table("{}_fts".format(table.name))
+    triggers = {trigger.name for trigger in table.triggers}
+    expected_triggers = {
+        "{}_{}".format(table.name, suffix) for suffix in "ai ad au".split()
+    }
+    if (
+        fts_table.exists()
+        and [column.name for column in fts_table.columns] == FTS_COLUMNS
+        and "tokenize='porter'" in fts_table.schema
+        and expected_triggers.issubset(triggers)
+    ):
+        return False
+    print("Configuring full-text search for {}".format(table.name))
+    table.enable_fts(FTS_COLUMNS, tokenize="porter", create_triggers=True, replace=True)
+    return True
+
+
+def ensure_trigram_fts(db, table):
+    """
+    Configure til_trigram, a trigram FTS5 index used for substring searches
+    for code, CLI flags and file paths. Needs SQLite 3.34 or higher - the
+    search canned query uses it, so the build fails without it.
+    """
+    trigram_name = "{}_trigram".format(table.name)
+    triggers = {trigger.name for trigger in table.triggers}
+    expected_triggers = {
+        "{}_{}".format(trigram_name, suffix) for suffix in "ai ad au".split()
+    }
+    if (
+        db.table(trigram_name).exists()
+        and [column.name for column in db.table(trigram_name).columns] == FTS_COLUMNS
+        and expected_triggers.issubset(triggers)
+    ):
+        return False
+    print("Configuring trigram search for {}".format(table.name))
+    sql = TRIGRAM_SQL.format(
+        table=table.name,
+        columns=", ".join("[{}]".format(column) for column in FTS_COLUMNS),
+        new_columns=", ".join("new.[{}]".format(column) for column in FTS_COLUMNS),
+        old_columns=", ".join("old.[{}]".format(column) for column in FTS_COLUMNS),
+    )
+    drops = "".join(
+        "drop trigger if exists [{}];\n".format(name) for name in expected_triggers
+    ) + "drop table if exists [{}];\n".format(trigram_name)
+    try:
+        db.conn.executescript("begin;\n" + drops + sql + "commit;")
+    except sqlite3.OperationalError as ex:
+        db.conn.rollback()
+        raise RuntimeError(
+            "Could not configure trigram search, which needs SQLite 3.34 or "
+            "higher (this is {}): {}".format(sqlite3.sqlite_version, ex)
+        ) from ex
+    return True
+
+
+def fts_names(db, table):
+    return [
+        name
+        for name in ("{}_fts".format(table.name), "{}_trigram".format(table.name))
+        if db.table(name).exists()
+    ]
+
+
+def maintain_fts(db, table, fts_to_maintain):
+    "Merge FTS segments after writes, with a full optimize every so often"
+    if not fts_to_maintain:
+        return
+    state = db.table("build_state", pk="key")
+    try:
+        builds = int(state.get("fts_builds_since_optimize")["value"]) + 1
+    except NotFoundError:
+        builds = 1
+    with db.atomic():
+        for fts_name in fts_to_maintain:
+            if builds >= FTS_OPTIMIZE_EVERY:
+                db.execute(
+                    "insert into [{0}]([{0}]) values ('optimize')".format(fts_name)
+                )
+                print("Optimized {}".format(fts_name))
+            else:
+                # Bounded amount of incremental merge work
+                db.execute(
+                    "insert into [{0}]([{0}], rank) values ('merge', 500)".format(
+                        fts_name
+                    )
+                )
+        if builds >= FTS_OPTIMIZE_EVERY:
+            builds = 0
+        state.upsert(
+            {"key": "fts_builds_since_optimize", "value": str(builds)}, pk="key"
+        )
+
+
+def check_fts(db, table):
+    "Returns a list of problems with the full-text indexes, empty if healthy"
+    problems = []
+    for fts_name in ("{}_fts".format(table.name), "{}_trigram".format(table.name)):
+        if not db.table(fts_name).exists():
+            problems.append("{} does not exist".format(fts_name))
+            continue
+        row_count = db.execute(
+            "select count(*) from [{}]".format(table.name)
+        ).fetchone()[0]
+        indexed_count = db.execute(
+            "select count(*) from [{}_docsize]".format(fts_name)
+        ).fetchone()[0]
+        if row_count != indexed_count:
+            problems.append(
+                "{} has {} rows but {} has {} documents".format(
+                    table.name, row_count, fts_name, indexed_count
+                )
+            )
+        try:
+            # rank=1 also compares the index against the content table
+            db.execute(
+                "insert into [{0}]([{0}], rank) values ('integrity-check', 1)".format(
+                    fts_name
+                )
+            )
+        except sqlite3.DatabaseError as ex:
+            problems.append("{} integrity-check failed: {}".format(fts_name, ex))
+    return problems
+
+
+def read_files(args):
+    "Runs in a worker: returns (path, title, body, duration) for each file"
+    repo_path, paths = args
+    files = []
+    for path in paths:
+        start = time.perf_counter()
+        with (repo_path / path).open() as fp:
+            title = fp.readline().lstrip("#").strip()
+            body = fp.read().strip()
+        files.append((path, title, body, time.perf_counter() - start))
+    return files
+
+
+def summarize(htmls):
+    "Runs in a worker: returns (first_paragraph_html, summary, duration) for each"
+    summaries = []
+    for html in htmls:
+        start = time.perf_counter()
+        paragraph_html, summary = first_paragraph_html_and_text(html)
+        summaries.append((paragraph_html, summary, time.perf_counter() - start))
+    return summaries
+
+
+def ordered_map(executor, fn, items, window):
+    """
+    Yields (context, fn(arg)) for each (context, arg) in items, in order,
+    with at most window calls in flight on the executor - items is consumed
+    lazily, so memory stays bounded. Calls fn inline if executor is None.
+    """
+    if executor is None:
+        for context, arg in items:
+            yield context, fn(arg)
+        return
+    pending = deque()
+    for context, arg in items:
+        pending.append((context, executor.submit(fn, arg)))
+        if len(pending) >= window:
+            context, future = pending.popleft()
+            yield context, future.result()
+    while pending:
+        context, future = pending.popleft()
+        yield context, future.result()
+
+
+def build_database(repo_path, workers=WORKERS):
+    """
+    Returns {"changed": [...], "deleted": [...]} listing the til rows that
+    were added or updated and the ones that were deleted
+    """
+    start = time.perf_counter()
     db = sqlite_utils.Database(repo_path / "tils.db")
     table = db.table("til", pk="path")
-    for filepath in root.glob("*/*.md"):
-        fp = filepath.open()
-        title = fp.readline().lstrip("#").strip()
-        body = fp.read().strip()
-        path = str(filepath.relative_to(root))
-        slug = filepath.stem
-        url = "https://github.com/simonw/til/blob/main/{}".format(path)
-        # Do we need to render the markdown?
-        path_slug = path.replace("/", "_")
-        try:
-            row = table.get(path_slug)
-            previous_body = row["body"]
-            previous_html = row["html"]
-        except (NotFoundError, KeyError):
-            previous_body = None
-            previous_html = None
-        record = {
-            "path": path_slug,
-            "slug": slug,
-            "topic": path.split("/")[0],
-            "title": title,
-            "url": url,
-            "body": body,
+    manifest = db.table("build_manifest", pk="path")
+    with instrument.stage("git_history"):
+        all_file_times = get_file_times_index(db, repo_path)
+    backend = markdown_render.get_backend()
+    # Kept out of the repo root so "datasette ." does not serve it
+    render_cache_path = pathlib.Path(
+        os.environ.get("RENDER_CACHE_DB") or (repo_path / ".cache" / "render_cache.db")
+    )
+    render_cache_path.parent.mkdir(parents=True, exist_ok=True)
+    render_cache = markdown_render.RenderCache(
+        sqlite_utils.Database(render_cache_path), backend
+    )
+    # HTML stored by a different backend needs to be rendered again
+    state = db.table("build_state", pk="key")
+    try:
+        previous_backend = state.get("markdown_backend")["value"]
+    except NotFoundError:
+        previous_backend = markdown_render.GitHubBackend.name
+    backend_changed = previous_backend != backend.name
+
+    # Skip any file whose contents and created/updated times are unchanged
+    fingerprints = {}
+    with instrument.stage("fingerprints"):
+        file_fingerprints = get_file_fingerprints(repo_path)
+    for path, fingerprint in file_fingerprints.items():
+        file_times = all_file_times.get(path) or {}
+        fingerprints[path.replace("/", "_")] = (
+            path,
+            "{}|{}".format(fingerprint, file_times.get("updated")),
+        )
+    manifest_fingerprints = {}
+    if manifest.exists():
+        manifest_fingerprints = {
+            row["path"]: row["fingerprint"] for row in manifest.rows
         }
-        if (body != previous_body) or not previous_html:
-            retries = 0
-            response = None
-            while retries < 3:
-                headers = {}
-                if os.environ.get("MARKDOWN_GITHUB_TOKEN"):
-                    headers = {
-                        "authorization": "Bearer {}".format(
-                            os.environ["MARKDOWN_GITHUB_TOKEN"]
-                        )
-                    }
-                response = httpx.post(
-                    "https://api.github.com/markdown",
-                    json={
-                        # mode=gfm would expand #13 issue links and suchlike
-                        "mode": "markdown",
-                        "text": body,
-                    },
-                    headers=headers,
+    previous_fingerprints = {} if backend_changed else manifest_fingerprints
+    existing_paths = set()
+    if table.exists():
+        existing_paths = {row[0] for row in db.execute("select path from til")}
+    changed = [
+        path_slug
+        for path_slug, (_, fingerprint) in fingerprints.items()
+        if previous_fingerprints.get(path_slug) != fingerprint
+        or path_slug not in existing_paths
+    ]
+    deleted = sorted((existing_paths | set(manifest_fingerprints)) - set(fingerprints))
+
+    # Files are read and summarized in worker processes, a chunk at a time,
+    # while this process renders Markdown and writes each chunk in order
+    chunks = [changed[i : i + CHUNK_SIZE] for i in range(0, len(changed), CHUNK_SIZE)]
+    workers = max(1, min(workers, len(chunks)))
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    window = workers * QUEUE_CHUNKS_PER_WORKER
+    table_existed = table.exists()
+    render_duration = 0.0
+    rendered_count = 0
+
+    def rendered_chunks(read_chunks):
+        "Yields (records, htmls) for each chunk of files read by the workers"
+        nonlocal render_duration, rendered_count
+        for path_slugs, files in read_chunks:
+            previous_rows = {}
+            if table_existed:
+                sql = "select path, body, html from til where path in ({})".format(
+                    ", ".join("?" for _ in path_slugs)
                 )
-                if response.status_code == 200:
-                    record["html"] = response.text
-                    print("Rendered HTML for {}".format(path))
-                    break
-                elif response.status_code == 401:
-                    assert False, "401 Unauthorized error rendering markdown"
+                for path_slug, body, html in db.execute(sql, path_slugs):
+                    previous_rows[path_slug] = (body, html)
+            records = []
+            to_render = {}
+            already_rendered = {}
+            for path_slug, (path, title, body, duration) in zip(path_slugs, files):
+                instrument.event("file", "read", duration, path=path)
+                # Do we need to render the markdown?
+                previous_body, previous_html = previous_rows.get(
+                    path_slug, (None, None)
+                )
+                record = {
+                    "path": path_slug,
+                    "slug": pathlib.Path(path).stem,
+                    "topic": path.split("/")[0],
+                    "title": title,
+                    "url": "https://github.com/simonw/til/blob/main/{}".format(path),
+                    "body": body,
+                }
+                if (body != previous_body) or not previous_html or backend_changed:
+                    to_render[path] = body
                 else:
-                    print(response.status_code, response.headers)
-                    print("  sleeping 60s")
-                    time.sleep(60)
-                    retries += 1
-            else:
-                assert False, "Could not render {} - last response was {}".format(
-                    path, response.headers
+                    already_rendered[body] = previous_html
+                # Get created/updated times, following renames
+                file_times = all_file_times.get(path)
+                if file_times:
+                    record.update(file_times)
+                records.append((path, record, previous_html))
+            render_start = time.perf_counter()
+            # Make sure HTML from previous builds is in the cache
+            render_cache.seed(already_rendered)
+            # Render all changed Markdown in the chunk in one batch, skipping
+            # anything cached
+            rendered = render_cache.render_batch(to_render)
+            render_duration += time.perf_counter() - render_start
+            rendered_count += len(to_render)
+            for path, record, previous_html in records:
+                record["html"] = rendered.get(path) or previous_html
+            yield records, [record["html"] or "" for _, record, _ in records]
+
+    read_chunks = ordered_map(
+        executor,
+        read_files,
+        ((chunk, (repo_path, [fingerprints[p][0] for p in chunk])) for chunk in chunks),
+        window,
+    )
+    db_duration = 0.0
+    process_start = time.perf_counter()
+    try:
+        # Write everything in a single transaction
+        with db.atomic():
+            for records, summaries in ordered_map(
+                executor, summarize, rendered_chunks(read_chunks), window
+            ):
+                for (path, record, _), (paragraph_html, summary, duration) in zip(
+                    records, summaries
+                ):
+                    instrument.event("file", "summary", duration, path=path)
+                    # Populate summary and the teaser HTML used by the index pages
+                    record["first_paragraph_html"] = paragraph_html
+                    record["summary"] = summary
+                write_start = time.perf_counter()
+                table.upsert_all(
+                    (record for _, record, _ in records), pk="path", alter=True
+                )
+                manifest.upsert_all(
+                    (
+                        {
+                            "path": record["path"],
+                            "fingerprint": fingerprints[record["path"]][1],
+                        }
+                        for _, record, _ in records
+                    ),
+                    pk="path",
                 )
-        # Populate summary
-        record["summary"] = first_paragraph_text_only(
-            record.get("html") or previous_html or ""
+                db_duration += time.perf_counter() - write_start
+            write_start = time.perf_counter()
+            for path_slug in deleted:
+                print("Deleted {}".format(path_slug))
+                if path_slug in existing_paths:
+                    table.delete(path_slug)
+                if path_slug in manifest_fingerprints:
+                    manifest.delete(path_slug)
+            state.upsert({"key": "markdown_backend", "value": backend.name}, pk="key")
+            db_duration += time.perf_counter() - write_start
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        # One HTTP client and rate limit gate are shared by every chunk
+        backend.close()
+    instrument.event(
+        "stage",
+        "process_files",
+        time.perf_counter() - process_start,
+        files=len(changed),
+        workers=workers,
+    )
+    instrument.event("stage", "render", render_duration, files=rendered_count)
+    instrument.event("stage", "write", db_duration)
+    evicted = render_cache.evict()
+    print(
+        "Render cache: {} hits, {} misses, {} evicted".format(
+            render_cache.hits, render_cache.misses, evicted
+        )
+    )
+    instrument.count("render_cache.hits", render_cache.hits)
+    instrument.count("render_cache.misses", render_cache.misses)
+    instrument.count("render_cache.evicted", evicted)
+
+    if table.exists():
+        with instrument.stage("indexes_and_topics"):
+            backfill_first_paragraphs(db, table)
+            ensure_indexes(table)
+            if changed or deleted or not db.table("topics").exists():
+                update_topics(db)
+
+    with instrument.stage("fts"):
+        rebuilt = set()
+        if ensure_fts(db, table):
+            rebuilt.add("til_fts")
+        if ensure_trigram_fts(db, table):
+            rebuilt.add("til_trigram")
+        if changed or deleted:
+            maintain_fts(
+                db,
+                table,
+                [name for name in fts_names(db, table) if name not in rebuilt],
+            )
+    added = sum(1 for path_slug in changed if path_slug not in existing_paths)
+    instrument.count("files.added", added)
+    instrument.count("files.changed", len(changed) - added)
+    instrument.count("files.skipped", len(fingerprints) - len(changed))
+    instrument.count("files.deleted", len(deleted))
+    print(
+        "Built database: {} added, {} changed, {} skipped, {} deleted "
+        "in {:.2f}s ({:.3f}s writing)".format(
+            added,
+            len(changed) - added,
+            len(fingerprints) - len(changed),
+            len(deleted),
+            time.perf_counter() - start,
+            db_duration,
         )
-        # Get created/updated times, following renames
-        file_times = get_file_times(repo_path, path)
-        if file_times:
-            record.update(file_times)
-        with db.conn:
-            table.upsert(record, alter=True)
-
-    table.enable_fts(
-        ["title", "body"], tokenize="porter", create_triggers=True, replace=True
     )
+    # pipeline.py switches tils.db out of WAL mode once every stage is done
+    db.close()
+    return {"changed": changed, "deleted": deleted}
 
 
 if __name__ == "__main__":
-    build_database(root)
+    if "--check-fts" in sys.argv:
+        db = sqlite_utils.Database(root / "tils.db")
+        problems = check_fts(db, db.table("til"))
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("Full-text indexes are healthy")
+    else:
+        workers = WORKERS
+        if "--workers" in sys.argv:
+            workers = int(sys.argv[sys.argv.index("--workers") + 1])
+        with instrument.build_run("build_database", root / "tils.db"):
+            build_database(root, workers=workers)
@@ -0,0 +1,205 @@
+"""
+Run this after build_database.py - calculates related TILs locally using
+TF-IDF vectors and cosine similarity, writing the top matches for each TIL
+to the similarities table used by related_tils() in plugins/template_vars.py
+"""
+
+from collections import Counter
+import hashlib
+import instrument
+import math
+import numpy as np
+import pathlib
+import re
+import sqlite_utils
+import sys
+import time
+
+root = pathlib.Path(__file__).parent.resolve()
+
+TOP_K = 10
+# Matrices bigger than this are randomly projected down to PROJECTED_DIMENSIONS
+MAX_DENSE_BYTES = 256 * 1024 * 1024
+PROJECTED_DIMENSIONS = 512
+# Rows of the similarity matrix calculated per matrix product
+BATCH_SIZE = 512
+# Recalculate everything if more than this fraction of documents changed
+FULL_RECALCULATE_FRACTION = 0.2
+
+token_re = re.compile(r"[a-z][a-z0-9_]+")
+
+
+def tokenize(text):
+    return token_re.findall(text.lower())
+
+
+def document_text(row):
+    # Count the title twice so it carries more weight than the body
+    return "{0}\n{0}\n{1}".format(row["title"], row["body"])
+
+
+def vectorize(texts):
+    """
+    Returns an L2-normalized float32 matrix of TF-IDF vectors, one row per
+    text, randomly projected if the full matrix would be too large
+    """
+    counts = [Counter(tokenize(text)) for text in texts]
+    num_docs = len(texts)
+    document_frequency = Counter()
+    for count in counts:
+        document_frequency.update(count.keys())
+    # Ignore terms that only appear once, or in more than half of documents
+    vocabulary = {
+        term: i
+        for i, term in enumerate(
+            sorted(
+                term
+                for term, df in document_frequency.items()
+                if df > 1 and df <= max(2, num_docs // 2)
+            )
+        )
+    }
+    idf = np.zeros(len(vocabulary), dtype=np.float32)
+    for term, i in vocabulary.items():
+        idf[i] = math.log((1 + num_docs) / (1 + document_frequency[term])) + 1
+    if num_docs * len(vocabulary) * 4 <= MAX_DENSE_BYTES:
+        projection = None
+        matrix = np.zeros((num_docs, len(vocabulary)), dtype=np.float32)
+    else:
+        # Johnson-Lindenstrauss: approximately preserves cosine similarity
+        rng = np.random.default_rng(0)
+        projection = rng.standard_normal(
+            (len(vocabulary), PROJECTED_DIMENSIONS), dtype=np.float32
+        )
+        matrix = np.zeros((num_docs, PROJECTED_DIMENSIONS), dtype=np.float32)
+    for row, count in enumerate(counts):
+        indexes = []
+        weights = []
+        for term, tf in count.items():
+            i = vocabulary.get(term)
+            if i is not None:
+                indexes.append(i)
+                # Sublinear term frequency
+                weights.append((1 + math.log(tf)) * idf[i])
+        if not indexes:
+            continue
+        if projection is None:
+            matrix[row, indexes] = weights
+        else:
+            matrix[row] = np.asarray(weights, dtype=np.float32) @ projection[indexes]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k(matrix, rows, k=TOP_K):
+    """
+    For each index in rows, yields (row, [(other_row, score), ...]) for the
+    k most similar other rows, using batched matrix products
+    """
+    k = min(k, len(matrix) - 1)
+    if k < 1:
+        return
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch = np.asarray(rows[start : start + BATCH_SIZE])
+        scores = matrix[batch] @ matrix.T
+        # Never match a document to itself
+        scores[np.arange(len(batch)), batch] = -np.inf
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for i, row in enumerate(batch):
+            best = candidates[i][np.argsort(-scores[i, candidates[i]])]
+            yield int(row), [(int(other), float(scores[i, other])) for other in best]
+
+
+def content_hash(row):
+    return hashlib.md5(document_text(row).encode("utf-8")).hexdigest()
+
+
+def build_similarities(db, k=TOP_K, recalculate_all=False):
+    "Returns the ids whose similarities were recalculated or deleted"
+    start = time.perf_counter()
+    rows = list(db.query("select path, title, body from til order by path"))
+    ids = [row["path"] for row in rows]
+    index_for_id = {id: i for i, id in enumerate(ids)}
+    hashes = {row["path"]: content_hash(row) for row in rows}
+
+    similarities = db.table("similarities", pk=("id", "other_id"))
+    hashes_table = db.table("similarity_hashes", pk="id")
+    previous_hashes = {}
+    if hashes_table.exists() and similarities.exists():
+        previous_hashes = {row["id"]: row["hash"] for row in hashes_table.rows}
+    changed = [id for id in ids if previous_hashes.get(id) != hashes[id]]
+    deleted = [id for id in previous_hashes if id not in hashes]
+    if not changed and not deleted and not recalculate_all:
+        print("Similarities are up to date")
+        return []
+
+    matrix = vectorize([document_text(row) for row in rows])
+    if recalculate_all or len(changed) > FULL_RECALCULATE_FRACTION * len(ids):
+        to_calculate = list(range(len(ids)))
+    else:
+        # Changed documents, plus any document whose top k included a
+        # changed or deleted document, or which a changed document now beats
+        affected = set(changed)
+        previous = {}
+        for row in db.query("select id, other_id, score from similarities"):
+            previous.setdefault(row["id"], []).append((row["other_id"], row["score"]))
+        touched = set(changed) | set(deleted)
+        for id, matches in previous.items():
+            if id in index_for_id and any(other in touched for other, _ in matches):
+                affected.add(id)
+        if changed:
+            changed_rows = np.asarray([index_for_id[id] for id in changed])
+            best_changed_scores = (matrix[changed_rows] @ matrix.T).max(axis=0)
+            for id, i in index_for_id.items():
+                matches = previous.get(id, [])
+                threshold = (
+                    min(score for _, score in matches) if len(matches) >= k else -1
+                )
+                if best_changed_scores[i] > threshold:
+                    affected.add(id)
+        to_calculate = sorted(index_for_id[id] for id in affected)
+
+    results = list(top_k(matrix, to_calculate, k))
+    with db.conn:
+        if similarities.exists():
+            recalculated = [ids[row] for row, _ in results] + deleted
+            for column, values in (("id", recalculated), ("other_id", deleted)):
+                for i in range(0, len(values), 500):
+                    chunk = values[i : i + 500]
+                    similarities.delete_where(
+                        "[{}] in ({})".format(column, ", ".join("?" for _ in chunk)),
+                        chunk,
+                    )
+        similarities.insert_all(
+            (
+                {"id": ids[row], "other_id": ids[other], "score": score}
+                for row, matches in results
+                for other, score in matches
+            ),
+            pk=("id", "other_id"),
+            replace=True,
+        )
+        hashes_table.upsert_all(
+            ({"id": id, "hash": hashes[id]} for id in changed), pk="id"
+        )
+        for id in deleted:
+            hashes_table.delete(id)
+    print(
+        "Calculated similarities for {} of {} TILs ({} changed, {} deleted) in {:.2f}s".format(
+            len(results),
+            len(ids),
+            len(changed),
+            len(deleted),
+            time.perf_counter() - start,
+        )
+    )
+    return [ids[row] for row, _ in results] + deleted
+
+
+if __name__ == "__main__":
+    with instrument.build_run("build_similarities", root / "tils.db"):
+        build_similarities(
+            sqlite_utils.Database(root / "tils.db"),
+            recalculate_all="--all" in sys.argv,
+        )
@@ -0,0 +1,273 @@
+"""
+Export the whole site to a directory of static files, rendering every page
+through Datasette's ASGI app in-process across a pool of worker processes:
+
+    python export_static.py [output_dir] [--workers N] [--all]
+
+Only pages whose rows changed since the last export are rendered again,
+unless --all is passed or the templates, plugins or metadata have changed.
+Redirects are written to a _redirects file in the format understood by
+Netlify and Cloudflare Pages.
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sqlite_utils
+import sys
+import time
+import urllib.parse
+
+root = pathlib.Path(__file__).parent.resolve()
+
+MANIFEST = "_export.json"
+WORKERS = int(os.environ.get("EXPORT_WORKERS", os.cpu_count() or 4))
+# Paths rendered per task sent to a worker process
+BATCH_SIZE = 50
+# Used for absolute URLs, as in the sitemap
+HOST = os.environ.get("EXPORT_HOST", "til.simonwillison.net")
+FIXED_REDIRECTS = ("/til", "/til/search", "/til/feed.atom")
+
+
+def hash_strings(*strings):
+    hasher = hashlib.sha256()
+    for s in strings:
+        hasher.update(s.encode("utf-8") + b"\0")
+    return hasher.hexdigest()
+
+
+def code_fingerprint():
+    "Changes whenever anything other than tils.db could change the output"
+    import datasette
+
+    hasher = hashlib.sha256(datasette.__version__.encode("utf-8"))
+    paths = [root / "metadata.yaml"]
+    for directory in ("templates", "plugins", "static"):
+        paths.extend(
+            path
+            for path in sorted((root / directory).rglob("*"))
+            if path.is_file() and "__pycache__" not in path.parts
+        )
+    for path in paths:
+        hasher.update(str(path.relative_to(root)).encode("utf-8") + b"\0")
+        hasher.update(path.read_bytes())
+    return hasher.hexdigest()
+
+
+def static_pages():
+    "Pages served from templates/pages/ that take no URL parameters"
+    pages_dir = root / "templates" / "pages"
+    return [
+        "/" + str(path.relative_to(pages_dir).with_suffix(""))
+        for path in sorted(pages_dir.rglob("*.html"))
+        if "{" not in str(path.relative_to(pages_dir))
+    ]
+
+
+def site_pages(db, code):
+    """
+    Returns {path: hash} for every page and redirect on the site, where the
+    hash covers the rows that page renders - so a page only needs exporting
+    again when its hash changes
+    """
+    related = {}
+    if db["similarities"].exists():
+        for row in db.query("""
+            select similarities.id, til.topic, til.slug, til.title, til.created
+            from similarities join til on til.path = similarities.other_id
+            order by similarities.id, similarities.score desc
+            """):
+            related.setdefault(row.pop("id"), []).append(row)
+    til_hashes = {}
+    topic_hashes = {}
+    for row in db.query("select * from til order by path"):
+        til_hash = hash_strings(
+            code,
+            json.dumps(row, sort_keys=True, default=str),
+            json.dumps(related.get(row["path"], []), sort_keys=True),
+        )
+        til_hashes[(row["topic"], row["slug"])] = til_hash
+        topic_hashes.setdefault(row["topic"], []).append(til_hash)
+    topic_hashes = {
+        topic: hash_strings(*hashes) for topic, hashes in topic_hashes.items()
+    }
+    site_hash = hash_strings(code, *sorted(topic_hashes.values()))
+
+    pages = {path: code for path in static_pages()}
+    for path in ("/", "/all", "/tils/feed.atom", "/sitemap.xml", "/robots.txt"):
+        pages[path] = site_hash
+    for path in FIXED_REDIRECTS:
+        pages[path] = code
+    for topic, topic_hash in topic_hashes.items():
+        pages["/{}".format(topic)] = topic_hash
+        pages[
+            "/tils/feed_by_topic.atom?" + urllib.parse.urlencode({"topic": topic})
+        ] = topic_hash
+    for (topic, slug), til_hash in til_hashes.items():
+        pages["/{}/{}".format(topic, slug)] = til_hash
+        # Handled by plugins/redirects.py
+        pages["/til/til/{}_{}.md".format(topic, slug)] = hash_strings(code, topic, slug)
+    return pages
+
+
+def table_redirects(db):
+    "{path: (status, location)} for TILs that have moved, from the redirects table"
+    if not db["redirects"].exists():
+        return {}
+    return {
+        row["from_path"]: (301, row["to_path"])
+        for row in db.query("select from_path, to_path from redirects")
+    }
+
+
+def output_path(path):
+    "The file within the export directory that stores a page"
+    path, _, query = path.partition("?")
+    if path == "/tils/feed_by_topic.atom":
+        topic = urllib.parse.parse_qs(query)["topic"][0]
+        return "tils/feed_by_topic/{}.atom".format(topic)
+    if path.endswith((".atom", ".xml", ".txt")):
+        return path.lstrip("/")
+    return (path.strip("/") + "/index.html").lstrip("/")
+
+
+datasette = None
+loop = None
+
+
+def init_worker():
+    from datasette.app import Datasette
+
+    global datasette, loop
+    datasette = Datasette([], config_dir=root, settings={"force_https_urls": True})
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(datasette.invoke_startup())
+
+
+async def render_pages_async(output_dir, paths):
+    results = []
+    for path in paths:
+        response = await datasette.client.get(path, headers={"host": HOST})
+        location = None
+        if response.status_code == 200:
+            destination = output_dir / output_path(path)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            destination.write_bytes(response.content)
+        elif response.status_code in (301, 302):
+            location = response.headers["location"]
+        results.append((path, response.status_code, location))
+    return results
+
+
+def render_pages(output_dir, paths):
+    "Runs in a worker process - returns (path, status, location) for each path"
+    return loop.run_until_complete(render_pages_async(output_dir, paths))
+
+
+def write_redirects(output_dir, redirects):
+    lines = [
+        # Static hosts can't route on query strings without a rewrite
+        "/tils/feed_by_topic.atom topic=:topic /tils/feed_by_topic/:topic.atom 200"
+    ]
+    for path, (status, location) in sorted(redirects.items()):
+        lines.append("{} {} {}".format(path, location, status))
+    (output_dir / "_redirects").write_text("\n".join(lines) + "\n")
+
+
+def export_static(output_dir, workers=WORKERS, export_all=False):
+    start = time.perf_counter()
+    output_dir = pathlib.Path(output_dir).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    db = sqlite_utils.Database(root / "tils.db")
+    code = code_fingerprint()
+    pages = site_pages(db, code)
+
+    manifest_path = output_dir / MANIFEST
+    previous = {"pages": {}, "redirects": {}}
+    if manifest_path.exists() and not export_all:
+        previous = json.loads(manifest_path.read_text())
+    to_render = sorted(
+        path
+        for path, page_hash in pages.items()
+        if previous["pages"].get(path) != page_hash
+        or (
+            path not in previous["redirects"]
+            and not (output_dir / output_path(path)).exists()
+        )
+    )
+    removed = [path for path in previous["pages"] if path not in pages]
+    for path in removed:
+        if path not in previous["redirects"]:
+            (output_dir / output_path(path)).unlink(missing_ok=True)
+
+    shutil.copytree(root / "static", output_dir / "static", dirs_exist_ok=True)
+    redirects = {
+        path: tuple(redirect)
+        for path, redirect in previous["redirects"].items()
+        if path in pages and path not in to_render
+    }
+    redirects.update(table_redirects(db))
+    rendered = {}
+    failed = []
+    batches = [
+        to_render[i : i + BATCH_SIZE] for i in range(0, len(to_render), BATCH_SIZE)
+    ]
+    if batches:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(batches)), initializer=init_worker
+        ) as executor:
+            futures = [
+                executor.submit(render_pages, output_dir, batch) for batch in batches
+            ]
+            for future in futures:
+                for path, status, location in future.result():
+                    if status == 200:
+                        rendered[path] = pages[path]
+                    elif location:
+                        rendered[path] = pages[path]
+                        redirects[path] = (status, location)
+                    else:
+                        failed.append((path, status))
+    write_redirects(output_dir, redirects)
+
+    manifest_pages = {
+        path: page_hash
+        for path, page_hash in previous["pages"].items()
+        if path in pages and path not in to_render
+    }
+    manifest_pages.update(rendered)
+    manifest_path.write_text(
+        json.dumps(
+            {"pages": manifest_pages, "redirects": redirects}, indent=2, sort_keys=True
+        )
+    )
+    print(
+        "Exported {} of {} pages to {} ({} unchanged, {} removed) in {:.2f}s".format(
+            len(rendered),
+            len(pages),
+            output_dir,
+            len(pages) - len(to_render),
+            len(removed),
+            time.perf_counter() - start,
+        )
+    )
+    for path, status in failed:
+        print("  {} returned {}".format(path, status))
+    return not failed
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    workers = WORKERS
+    if "--workers" in args:
+        i = args.index("--workers")
+        workers = int(args[i + 1])
+        del args[i : i + 2]
+    export_all = "--all" in args
+    args = [arg for arg in args if arg != "--all"]
+    ok = export_static(args[0] if args else "export", workers, export_all)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,156 @@
+"""
+Structured timings and counters for the build scripts, saved to the
+build_runs and build_events tables in tils.db. Set BUILD_EVENTS_JSON to a
+file path to also write each run out as JSON.
+
+    with instrument.build_run("build_database", root / "tils.db"):
+        with instrument.stage("render"):
+            ...
+        instrument.count("render_cache.hits", 12)
+"""
+
+import contextlib
+from datetime import datetime, timezone
+import json
+import os
+import pathlib
+import sqlite_utils
+import threading
+import time
+
+# Older runs keep their build_runs row but lose their individual events
+KEEP_EVENTS_FOR_RUNS = 50
+
+
+class BuildRun:
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now(timezone.utc).isoformat()
+        self.start = time.perf_counter()
+        self.events = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def event(self, kind, name, duration=None, **data):
+        now = time.perf_counter() - self.start
+        with self.lock:
+            self.events.append(
+                {
+                    "kind": kind,
+                    "name": name,
+                    "offset": round(now - (duration or 0), 6),
+                    "duration": None if duration is None else round(duration, 6),
+                    "data": data,
+                }
+            )
+
+    @contextlib.contextmanager
+    def timer(self, kind, name, **data):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.event(kind, name, time.perf_counter() - start, **data)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self, status):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "duration": round(time.perf_counter() - self.start, 6),
+            "status": status,
+            "counters": dict(sorted(self.counters.items())),
+            "events": self.events,
+        }
+
+    def save(self, db, status):
+        run = self.as_dict(status)
+        with db.conn:
+            run_id = (
+                db["build_runs"]
+                .insert(
+                    {
+                        "name": run["name"],
+                        "started": run["started"],
+                        "duration": run["duration"],
+                        "status": run["status"],
+                        "counters": json.dumps(run["counters"]),
+                    },
+                    pk="id",
+                    alter=True,
+                )
+                .last_pk
+            )
+            db["build_events"].insert_all(
+                (
+                    {
+                        "run_id": run_id,
+                        "seq": seq,
+                        "kind": event["kind"],
+                        "name": event["name"],
+                        "offset": event["offset"],
+                        "duration": event["duration"],
+                        "data": json.dumps(event["data"]) if event["data"] else None,
+                    }
+                    for seq, event in enumerate(run["events"])
+                ),
+                pk=("run_id", "seq"),
+                foreign_keys=[("run_id", "build_runs", "id")],
+                alter=True,
+            )
+            db.execute(
+                "delete from build_events where run_id <= ?",
+                [run_id - KEEP_EVENTS_FOR_RUNS],
+            )
+        db["build_events"].create_index(["run_id"], if_not_exists=True)
+        return run
+
+
+# Collects everything recorded by this process, even outside build_run()
+current = BuildRun("build")
+
+
+def stage(name, **data):
+    "Time a stage of the build"
+    return current.timer("stage", name, **data)
+
+
+def file_timer(name, path, **data):
+    "Time one step for a single file"
+    return current.timer("file", name, path=path, **data)
+
+
+def event(kind, name, duration=None, **data):
+    current.event(kind, name, duration, **data)
+
+
+def count(name, n=1):
+    current.count(name, n)
+
+
+@contextlib.contextmanager
+def build_run(name, db_path):
+    """
+    Record a run, then save it to build_runs and build_events in db_path -
+    including runs that fail
+    """
+    global current
+    previous, current = current, BuildRun(name)
+    run = current
+    status = "error"
+    try:
+        yield run
+        status = "ok"
+    finally:
+        current = previous
+        db = sqlite_utils.Database(db_path)
+        try:
+            saved = run.save(db, status)
+        finally:
+            db.close()
+        json_path = os.environ.get("BUILD_EVENTS_JSON")
+        if json_path:
+            pathlib.Path(json_path).write_text(json.dumps(saved, indent=2))
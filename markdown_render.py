@@ -0,0 +1,442 @@
+"Render Markdown in concurrent batches, with a content-addressed cache"
+
+import asyncio
+import hashlib
+import httpx
+import instrument
+import os
+import time
+
+GITHUB_MARKDOWN_URL = "https://api.github.com/markdown"
+CONCURRENCY = 8
+MAX_RETRIES = 3
+MAX_BACKOFF = 60
+# Least recently used entries are evicted once the cache is bigger than this
+MAX_CACHE_BYTES = 200 * 1024 * 1024
+
+
+def retry_delay(response, attempt, now=None):
+    """
+    How many seconds to wait before retrying a failed request, based on the
+    Retry-After and X-RateLimit-* headers where GitHub provides them
+    """
+    headers = response.headers
+    if headers.get("retry-after", "").isdigit():
+        return int(headers["retry-after"])
+    if (
+        headers.get("x-ratelimit-remaining") == "0"
+        and headers.get("x-ratelimit-reset", "").isdigit()
+    ):
+        now = time.time() if now is None else now
+        # Reset is a UTC epoch second - add one to avoid racing the clock
+        return max(0, int(headers["x-ratelimit-reset"]) - now) + 1
+    return min(MAX_BACKOFF, 2**attempt)
+
+
+class RateLimitGate:
+    "Shared by all workers so a rate limit seen by one pauses them all"
+
+    def __init__(self):
+        self.resume_at = 0
+
+    def pause_until(self, resume_at):
+        self.resume_at = max(self.resume_at, resume_at)
+
+    async def wait(self):
+        delay = self.resume_at - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def render_one(client, url, key, text, gate, semaphore):
+    start = time.perf_counter()
+    attempt = 0
+    response = None
+    while attempt <= MAX_RETRIES:
+        wait_start = time.perf_counter()
+        await gate.wait()
+        instrument.count("markdown_api.wait_seconds", time.perf_counter() - wait_start)
+        async with semaphore:
+            instrument.count("markdown_api.requests")
+            try:
+                response = await client.post(
+                    url,
+                    json={
+                        # mode=gfm would expand #13 issue links and suchlike
+                        "mode": "markdown",
+                        "text": text,
+                    },
+                )
+            except httpx.TransportError as ex:
+                print("  {} rendering {}".format(ex.__class__.__name__, key))
+                instrument.count("markdown_api.transport_errors")
+                response = None
+        if response is not None:
+            if response.status_code == 200:
+                if (
+                    response.headers.get("x-ratelimit-remaining") == "0"
+                    and response.headers.get("x-ratelimit-reset", "").isdigit()
+                ):
+                    gate.pause_until(int(response.headers["x-ratelimit-reset"]) + 1)
+                print("Rendered HTML for {}".format(key))
+                instrument.event(
+                    "file",
+                    "render",
+                    time.perf_counter() - start,
+                    path=key,
+                    attempts=attempt + 1,
+                )
+                return response.text
+            elif response.status_code == 401:
+                assert False, "401 Unauthorized error rendering markdown"
+            delay = retry_delay(response, attempt)
+            rate_limited = response.status_code in (403, 429)
+            print(response.status_code, response.headers)
+            instrument.count("markdown_api.status_{}".format(response.status_code))
+        else:
+            delay = min(MAX_BACKOFF, 2**attempt)
+            rate_limited = False
+        attempt += 1
+        if attempt <= MAX_RETRIES:
+            print("  retrying {} in {:.1f}s".format(key, delay))
+            instrument.count("markdown_api.retries")
+            if rate_limited:
+                instrument.count("markdown_api.rate_limited")
+                gate.pause_until(time.time() + delay)
+            else:
+                await asyncio.sleep(delay)
+                instrument.count("markdown_api.wait_seconds", delay)
+    assert False, "Could not render {} - last response was {}".format(
+        key, response.headers if response is not None else None
+    )
+
+
+class Renderer:
+    """
+    Renders batches through the API with one HTTP client, event loop and
+    rate limit gate, so a rate limit seen while rendering one batch still
+    applies to the next. Create one per build and close() it at the end.
+    """
+
+    def __init__(self, url=None, token=None, concurrency=CONCURRENCY, transport=None):
+        self.url = url or os.environ.get("MARKDOWN_API_URL") or GITHUB_MARKDOWN_URL
+        token = token or os.environ.get("MARKDOWN_GITHUB_TOKEN")
+        self.headers = {}
+        if token:
+            self.headers["authorization"] = "Bearer {}".format(token)
+        self.concurrency = concurrency
+        self.transport = transport
+        self.gate = RateLimitGate()
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.semaphore = None
+
+    async def render_batch_async(self, texts):
+        if self.client is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.client = httpx.AsyncClient(
+                headers=self.headers,
+                limits=httpx.Limits(max_connections=self.concurrency),
+                timeout=30,
+                transport=self.transport,
+            )
+        tasks = [
+            asyncio.ensure_future(
+                render_one(self.client, self.url, key, text, self.gate, self.semaphore)
+            )
+            for key, text in texts.items()
+        ]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # Fail fast: don't keep hammering the API after a fatal error
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return dict(zip(texts.keys(), results))
+
+    def render_batch(self, texts):
+        if not texts:
+            return {}
+        return self.loop.run_until_complete(self.render_batch_async(texts))
+
+    def close(self):
+        if self.client is not None:
+            self.loop.run_until_complete(self.client.aclose())
+            self.client = None
+        self.loop.close()
+
+
+def render_batch(texts, **kwargs):
+    """
+    Render a dictionary of {key: markdown} concurrently, returning
+    {key: html}. Set MARKDOWN_API_URL to point at a stand-in server.
+    """
+    if not texts:
+        return {}
+    renderer = Renderer(**kwargs)
+    try:
+        return renderer.render_batch(texts)
+    finally:
+        renderer.close()
+
+
+class GitHubBackend:
+    "Renders using the GitHub Markdown API - the default"
+
+    name = "github"
+    # mode=gfm would expand #13 issue links and suchlike
+    mode = "markdown"
+
+    def __init__(self):
+        self.renderer = None
+
+    def render_batch(self, texts):
+        if not texts:
+            return {}
+        if self.renderer is None:
+            self.renderer = Renderer()
+        return self.renderer.render_batch(texts)
+
+    def close(self):
+        if self.renderer is not None:
+            self.renderer.close()
+            self.renderer = None
+
+
+# The GitHub API's "markdown" mode follows Markdown.pl: only these characters
+# can be backslash escaped, so "\\@" stays as it is
+ESCAPABLE = set("\\`*_{}[]()#+-.!>")
+
+
+def github_escape(escape):
+    "Wraps markdown-it's escape rule to only escape ESCAPABLE characters"
+
+    def rule(state, silent):
+        if (
+            state.src[state.pos] == "\\"
+            and state.pos + 1 < state.posMax
+            and state.src[state.pos + 1] not in ESCAPABLE | {"\n"}
+        ):
+            return False
+        return escape(state, silent)
+
+    return rule
+
+
+def github_backtick(backtick):
+    """
+    Wraps markdown-it's backtick rule to keep newlines inside code spans, as
+    the GitHub API does - that's how it renders a fence with no blank line
+    before it, info string included
+    """
+
+    def rule(state, silent):
+        start = state.pos
+        tokens_before = len(state.tokens)
+        matched = backtick(state, silent)
+        if matched and not silent and len(state.tokens) > tokens_before:
+            token = state.tokens[-1]
+            if token.type == "code_inline":
+                marker = len(token.markup)
+                content = state.src[start + marker : state.pos - marker].strip("\n")
+                if (
+                    content.startswith(" ")
+                    and content.endswith(" ")
+                    and content.strip()
+                ):
+                    content = content[1:-1]
+                token.content = content
+        return matched
+
+    return rule
+
+
+def github_newline(newline):
+    "Wraps markdown-it's newline rule to keep indentation on the next line"
+
+    def rule(state, silent):
+        start = state.pos
+        matched = newline(state, silent)
+        if matched and not silent:
+            state.pending += state.src[start + 1 : state.pos]
+        return matched
+
+    return rule
+
+
+class LocalBackend:
+    """
+    Renders offline using markdown-it-py's GFM-like preset - tables,
+    strikethrough and autolinked URLs - adjusted to match the GitHub API's
+    "markdown" mode: fences can't interrupt a paragraph, only the Markdown.pl
+    characters can be backslash escaped, indentation within a paragraph is
+    kept and only URLs with a scheme are linked
+    """
+
+    mode = "gfm-like"
+
+    def __init__(self):
+        try:
+            import markdown_it
+            from markdown_it import rules_block, rules_inline
+        except ImportError:
+            raise RuntimeError(
+                "MARKDOWN_BACKEND=local needs: pip install 'markdown-it-py[linkify]'"
+            )
+        self.md = markdown_it.MarkdownIt(self.mode)
+        self.md.block.ruler.at(
+            "fence", rules_block.fence, {"alt": ["reference", "blockquote", "list"]}
+        )
+        self.md.inline.ruler.at("escape", github_escape(rules_inline.escape))
+        self.md.inline.ruler.at("backticks", github_backtick(rules_inline.backtick))
+        self.md.inline.ruler.at("newline", github_newline(rules_inline.newline))
+        # Otherwise "setup.py" becomes a link
+        self.md.linkify.set({"fuzzy_link": False})
+        # Include the version so upgrading markdown-it-py invalidates the cache,
+        # and a revision for changes to the rules above
+        self.name = "local-markdown-it-{}-2".format(markdown_it.__version__)
+
+    def render_batch(self, texts):
+        rendered = {}
+        for key, text in texts.items():
+            with instrument.file_timer("render", key):
+                rendered[key] = self.md.render(text)
+        return rendered
+
+    def close(self):
+        pass
+
+
+BACKENDS = {
+    "github": GitHubBackend,
+    "local": LocalBackend,
+}
+
+
+def get_backend(name=None):
+    "Pick a backend by name, defaulting to the MARKDOWN_BACKEND environment variable"
+    name = name or os.environ.get("MARKDOWN_BACKEND") or "github"
+    if name not in BACKENDS:
+        raise ValueError(
+            "Unknown MARKDOWN_BACKEND {!r}, should be one of {}".format(
+                name, ", ".join(BACKENDS)
+            )
+        )
+    return BACKENDS[name]()
+
+
+class RenderCache:
+    """
+    HTML keyed by a hash of the backend, render mode and Markdown text, so
+    it can be shared across paths and survive a rebuild of tils.db
+    """
+
+    def __init__(self, db, backend, max_bytes=MAX_CACHE_BYTES):
+        self.db = db
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.table = db.table("render_cache", pk="key")
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return hashlib.sha256(
+            "{}\0{}\0{}".format(self.backend.name, self.backend.mode, text).encode(
+                "utf-8"
+            )
+        ).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        if self.table.exists():
+            keys = list(keys)
+            # Stay under SQLite's limit on the number of ? parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                sql = "select key, html from render_cache where key in ({})".format(
+                    ", ".join("?" for _ in chunk)
+                )
+                found.update(self.db.execute(sql, chunk).fetchall())
+            if found:
+                with self.db.conn:
+                    self.db.conn.executemany(
+                        "update render_cache set last_used = ? where key = ?",
+                        [(time.time(), key) for key in found],
+                    )
+        return found
+
+    def put_many(self, htmls):
+        now = time.time()
+        with self.db.conn:
+            self.table.upsert_all(
+                (
+                    {
+                        "key": key,
+                        "backend": self.backend.name,
+                        "html": html,
+                        "size": len(html.encode("utf-8")),
+                        "last_used": now,
+                    }
+                    for key, html in htmls.items()
+                ),
+                pk="key",
+            )
+
+    def seed(self, htmls_by_text):
+        "Add {markdown: html} pairs rendered by this backend if not yet cached"
+        with self.db.conn:
+            self.table.insert_all(
+                (
+                    {
+                        "key": self.key(text),
+                        "backend": self.backend.name,
+                        "html": html,
+                        "size": len(html.encode("utf-8")),
+                        "last_used": time.time(),
+                    }
+                    for text, html in htmls_by_text.items()
+                ),
+                pk="key",
+                ignore=True,
+            )
+
+    def render_batch(self, texts):
+        "Like backend.render_batch() but only renders cache misses"
+        keys = {name: self.key(text) for name, text in texts.items()}
+        cached = self.get_many(set(keys.values()))
+        misses = {
+            name: text for name, text in texts.items() if keys[name] not in cached
+        }
+        self.hits += len(texts) - len(misses)
+        self.misses += len(misses)
+        rendered = self.backend.render_batch(misses)
+        if rendered:
+            self.put_many({keys[name]: html for name, html in rendered.items()})
+        results = {name: cached[key] for name, key in keys.items() if key in cached}
+        results.update(rendered)
+        return results
+
+    def evict(self):
+        "Delete least recently used entries until the cache fits in max_bytes"
+        if not self.table.exists():
+            return 0
+        total = self.db.execute(
+            "select coalesce(sum(size), 0) from render_cache"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        to_delete = []
+        for key, size in self.db.execute(
+            "select key, size from render_cache order by last_used"
+        ):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        with self.db.conn:
+            self.db.conn.executemany(
+                "delete from render_cache where key = ?", to_delete
+            )
+        return len(to_delete)
@@ -0,0 +1,330 @@
+"""
+Run the whole build as a graph of stages:
+
+    python pipeline.py [--all] [--workers N] [--reconcile]
+
+Each stage declares the artifacts it reads and writes, and is passed the
+keys that changed in each of its inputs - usually til paths. A stage is
+skipped when none of its inputs changed, and stages that don't depend on
+each other run in parallel.
+
+If a stage fails, the changes it and the stages after it did not get to
+are kept in build_state and passed to them again on the next run.
+
+--all runs every stage regardless of what changed. --reconcile checks the
+bucket for missing screenshots and takes them again.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
+import hashlib
+import json
+import os
+import pathlib
+import sqlite_utils
+from sqlite_utils.db import NotFoundError
+import sys
+import time
+
+import build_database
+import build_similarities
+import generate_screenshots
+import instrument
+import update_readme
+
+root = pathlib.Path(__file__).parent.resolve()
+
+# Always treated as changed - build_database.py works out what really changed
+ALWAYS = "markdown"
+# Stages that run in parallel, like similarities and screenshots, write to
+# tils.db at the same time - each waits this long for the other's lock
+BUSY_TIMEOUT_MS = 60 * 1000
+
+
+class Stage:
+    def __init__(self, name, fn, inputs, outputs):
+        self.name = name
+        self.fn = fn
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def __repr__(self):
+        return "<Stage {}>".format(self.name)
+
+
+def templates_fingerprint(root):
+    "Hash of everything besides tils.db that affects how pages render"
+    hasher = hashlib.sha256()
+    paths = [root / "metadata.yaml"]
+    for directory in ("templates", "plugins", "static"):
+        paths.extend(
+            path
+            for path in sorted((root / directory).rglob("*"))
+            if path.is_file() and "__pycache__" not in path.parts
+        )
+    for path in paths:
+        hasher.update(str(path.relative_to(root)).encode("utf-8") + b"\0")
+        hasher.update(path.read_bytes())
+    return hasher.hexdigest()
+
+
+@contextlib.contextmanager
+def open_database(root):
+    "tils.db for a stage, closed afterwards so main() can leave WAL mode"
+    db = sqlite_utils.Database(root / "tils.db")
+    db.execute("PRAGMA busy_timeout = {}".format(BUSY_TIMEOUT_MS))
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def run_database(root, changes, options):
+    result = build_database.build_database(root)
+    return {"til": set(result["changed"]) | set(result["deleted"])}
+
+
+def run_similarities(root, changes, options):
+    with open_database(root) as db:
+        return {
+            "similarities": set(
+                build_similarities.build_similarities(
+                    db, recalculate_all=options.get("all", False)
+                )
+            )
+        }
+
+
+def run_screenshots(root, changes, options):
+    # A template change can affect every page, and --reconcile can find any
+    # shot missing - otherwise only changed rows need a new screenshot
+    paths = None
+    if not (changes["templates"] or changes["stored_shots"] or options.get("all")):
+        paths = changes["til"]
+    with open_database(root) as db:
+        shot = generate_screenshots.generate_screenshots(
+            root,
+            workers=options.get("workers", generate_screenshots.WORKERS),
+            reconcile=options.get("reconcile", False),
+            paths=paths,
+            db=db,
+        )
+    return {"shots": set(shot)}
+
+
+def run_readme(root, changes, options):
+    with open_database(root) as db:
+        if update_readme.rewrite_readme(db, root / "README.md"):
+            return {"readme": {"README.md"}}
+    return {"readme": set()}
+
+
+def run_vacuum(root, changes, options):
+    with open_database(root) as db:
+        db.vacuum()
+    return {}
+
+
+STAGES = [
+    Stage("database", run_database, inputs=[ALWAYS], outputs=["til"]),
+    Stage("similarities", run_similarities, inputs=["til"], outputs=["similarities"]),
+    Stage(
+        "screenshots",
+        run_screenshots,
+        inputs=["til", "templates", "stored_shots"],
+        outputs=["shots"],
+    ),
+    Stage("readme", run_readme, inputs=["til"], outputs=["readme"]),
+    Stage("vacuum", run_vacuum, inputs=["til", "similarities", "shots"], outputs=[]),
+]
+
+
+def dependencies(stages):
+    "{stage: set of stages that write one of its inputs}"
+    writers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            writers.setdefault(output, set()).add(stage)
+    return {
+        stage: {writer for input in stage.inputs for writer in writers.get(input, ())}
+        - {stage}
+        for stage in stages
+    }
+
+
+def run_pipeline(
+    root, stages=STAGES, options=None, initial_changes=None, unprocessed=None
+):
+    """
+    Run stages in dependency order, in parallel where possible. Returns
+    {artifact: set of changed keys} and {stage name: seconds or None}.
+
+    unprocessed is {stage name: {input: set of keys}} for changes a stage
+    has not handled yet, because it or a stage it depends on failed. It is
+    added to what each stage is passed, and updated in place: a stage is
+    removed once it succeeds, and if a stage fails every stage that did not
+    finish keeps its changes for the next run.
+    """
+    options = options or {}
+    unprocessed = {} if unprocessed is None else unprocessed
+    changes = {ALWAYS: {ALWAYS}}
+    changes.update(initial_changes or {})
+    depends_on = dependencies(stages)
+    timings = {}
+    done = set()
+    pending = set(stages)
+    running = {}
+    error = None
+
+    def run(stage, stage_changes):
+        start = time.perf_counter()
+        with instrument.stage(stage.name):
+            outputs = stage.fn(root, stage_changes, options)
+        return outputs, time.perf_counter() - start
+
+    def changes_for(stage):
+        previous = unprocessed.get(stage.name, {})
+        return {
+            input: set(changes.get(input, ())) | set(previous.get(input, ()))
+            for input in stage.inputs
+        }
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while (pending and error is None) or running:
+            for stage in sorted(pending, key=stages.index):
+                if error is not None or not depends_on[stage] <= done:
+                    continue
+                pending.remove(stage)
+                stage_changes = changes_for(stage)
+                if options.get("all") or any(stage_changes.values()):
+                    print("== Starting {}".format(stage.name))
+                    future = executor.submit(run, stage, stage_changes)
+                    running[future] = (stage, stage_changes)
+                else:
+                    print("== Skipping {} - inputs unchanged".format(stage.name))
+                    instrument.event("stage", stage.name, skipped=True)
+                    timings[stage.name] = None
+                    for output in stage.outputs:
+                        changes.setdefault(output, set())
+                    unprocessed.pop(stage.name, None)
+                    done.add(stage)
+            if not running:
+                if (
+                    error is None
+                    and pending
+                    and not any(depends_on[s] <= done for s in pending)
+                ):
+                    raise ValueError("Stages have circular dependencies")
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, stage_changes = running.pop(future)
+                try:
+                    outputs, duration = future.result()
+                except Exception as e:
+                    # Let stages that are already running finish, but start
+                    # no more - what they would have done waits for next time
+                    print("== Failed {}: {}".format(stage.name, e))
+                    unprocessed[stage.name] = stage_changes
+                    error = error or e
+                    continue
+                for output in stage.outputs:
+                    changes.setdefault(output, set()).update(
+                        (outputs or {}).get(output, ())
+                    )
+                timings[stage.name] = duration
+                unprocessed.pop(stage.name, None)
+                done.add(stage)
+                print("== Finished {} in {:.2f}s".format(stage.name, duration))
+    if error is not None:
+        for stage in pending:
+            unprocessed[stage.name] = changes_for(stage)
+        raise error
+    return changes, timings
+
+
+def load_unprocessed(state):
+    "Changes left over by a failed run, stored in build_state"
+    try:
+        saved = json.loads(state.get("pipeline_unprocessed")["value"])
+    except NotFoundError:
+        return {}
+    return {
+        stage: {input: set(keys) for input, keys in inputs.items()}
+        for stage, inputs in saved.items()
+    }
+
+
+def save_unprocessed(state, unprocessed):
+    saved = {
+        stage: {input: sorted(keys) for input, keys in inputs.items()}
+        for stage, inputs in unprocessed.items()
+    }
+    state.upsert({"key": "pipeline_unprocessed", "value": json.dumps(saved)}, pk="key")
+
+
+def main(args):
+    options = {
+        "all": "--all" in args,
+        "reconcile": "--reconcile" in args,
+    }
+    if "--workers" in args:
+        options["workers"] = int(args[args.index("--workers") + 1])
+
+    # Templates are compared against the fingerprint from the last build
+    db = sqlite_utils.Database(root / "tils.db")
+    state = db.table("build_state", pk="key")
+    fingerprint = templates_fingerprint(root)
+    try:
+        previous = state.get("templates_fingerprint")["value"]
+    except NotFoundError:
+        previous = None
+    initial_changes = {
+        "templates": {"templates"} if fingerprint != previous else set(),
+        # Shots --reconcile finds missing from the bucket need taking again
+        "stored_shots": {"stored_shots"} if options["reconcile"] else set(),
+    }
+
+    # So parallel stages can read while another one writes. Switched back
+    # afterwards, so tils.db is uploaded and deployed as a single file
+    db.enable_wal()
+    start = time.perf_counter()
+    # Changes a stage missed because the last run failed
+    unprocessed = load_unprocessed(state)
+    try:
+        with instrument.build_run("pipeline", root / "tils.db"):
+            changes, timings = run_pipeline(
+                root,
+                options=options,
+                initial_changes=initial_changes,
+                unprocessed=unprocessed,
+            )
+        state.upsert({"key": "templates_fingerprint", "value": fingerprint}, pk="key")
+    finally:
+        save_unprocessed(state, unprocessed)
+        db.disable_wal()
+
+    print("Pipeline finished in {:.2f}s".format(time.perf_counter() - start))
+    for stage in STAGES:
+        duration = timings.get(stage.name)
+        print(
+            "  {:<14} {}".format(
+                stage.name,
+                "skipped" if duration is None else "{:.2f}s".format(duration),
+            )
+        )
+    for artifact in ("til", "similarities", "shots", "readme"):
+        print("  {:<14} {} changed".format(artifact, len(changes.get(artifact, ()))))
+    # Lets later workflow steps skip work, e.g. uploading an unchanged tils.db
+    if os.environ.get("GITHUB_OUTPUT"):
+        database_changed = any(
+            changes.get(artifact) for artifact in ("til", "similarities", "shots")
+        )
+        with open(os.environ["GITHUB_OUTPUT"], "a") as fp:
+            fp.write(
+                "database_changed={}\n".format("true" if database_changed else "false")
+            )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
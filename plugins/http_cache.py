@@ -0,0 +1,253 @@
+"""
+ETags, 304 Not Modified and a memory cache of compressed bodies for pages
+that only change when tils.db, the templates or the plugins change
+"""
+
+from collections import OrderedDict
+from datasette import hookimpl
+from datasette.plugins import pm
+import gzip
+import hashlib
+import os
+import pathlib
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CACHEABLE_PATHS = re.compile(
+    r"^/$|^/all$|^/tils/feed(_by_topic)?\.atom$"
+    # /{topic} and /{topic}/{slug}, but not /-/..., /static/... or /tils/...
+    r"|^/(?!-/|static/|tils(/|$))[^/.]+(/[^/.]+)?$"
+)
+MAX_CACHE_BYTES = int(os.environ.get("TIL_RESPONSE_CACHE_BYTES", 32 * 1024 * 1024))
+CACHE_CONTROL = "public, max-age={}".format(os.environ.get("TIL_CACHE_MAX_AGE", 300))
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 500
+
+
+class ResponseCache:
+    "LRU cache of responses bounded by the total size of the stored bodies"
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key, headers, bodies):
+        size = sum(len(body) for body in bodies.values())
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)["size"]
+        self.entries[key] = {"headers": headers, "bodies": bodies, "size": size}
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted["size"]
+
+
+response_cache = ResponseCache(MAX_CACHE_BYTES)
+
+
+def fingerprint_directories(directories):
+    "Hash of the paths and contents of every file in these directories"
+    hasher = hashlib.sha256()
+    for directory in directories:
+        if not directory:
+            continue
+        root = pathlib.Path(directory)
+        for path in sorted(p for p in root.rglob("*") if p.is_file()):
+            if "__pycache__" in path.parts:
+                continue
+            hasher.update(str(path.relative_to(root)).encode("utf-8") + b"\0")
+            hasher.update(path.read_bytes())
+    return hasher.hexdigest()
+
+
+def choose_encoding(accept_encoding, available):
+    accepted = {
+        part.split(";")[0].strip()
+        for part in accept_encoding.lower().split(",")
+        if not part.strip().endswith(";q=0")
+    }
+    for encoding in ("br", "gzip"):
+        if encoding in accepted and encoding in available:
+            return encoding
+    return "identity"
+
+
+def compressed_bodies(body):
+    bodies = {"identity": body}
+    if len(body) >= MIN_COMPRESS_BYTES:
+        bodies["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+        if brotli is not None:
+            bodies["br"] = brotli.compress(body)
+    return bodies
+
+
+async def send_not_modified(send, etag):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 304,
+            "headers": [
+                (b"etag", etag.encode("latin-1")),
+                (b"cache-control", CACHE_CONTROL.encode("latin-1")),
+                (b"vary", b"Accept-Encoding"),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send_cached(send, headers, etag, bodies, encoding, method):
+    body = bodies[encoding]
+    response_headers = headers + [
+        (b"etag", etag.encode("latin-1")),
+        (b"cache-control", CACHE_CONTROL.encode("latin-1")),
+        (b"vary", b"Accept-Encoding"),
+        (b"content-length", str(len(body)).encode("latin-1")),
+    ]
+    if encoding != "identity":
+        response_headers.append((b"content-encoding", encoding.encode("latin-1")))
+    await send(
+        {"type": "http.response.start", "status": 200, "headers": response_headers}
+    )
+    await send({"type": "http.response.body", "body": body if method == "GET" else b""})
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    fingerprint = {}
+    # The same version the query cache in template_vars.py is keyed on
+    database_version = next(
+        plugin.database_version
+        for plugin in pm.get_plugins()
+        if getattr(plugin, "__name__", None) == "template_vars.py"
+    )
+
+    def etag_for(scope):
+        if "code" not in fingerprint:
+            fingerprint["code"] = fingerprint_directories(
+                [datasette.template_dir, datasette.plugins_dir]
+            )
+        db = datasette.databases.get("tils")
+        if db is None:
+            return None
+        hasher = hashlib.sha256()
+        for part in (
+            database_version(db),
+            fingerprint["code"],
+            scope["path"],
+            scope.get("query_string", b"").decode("latin-1"),
+        ):
+            hasher.update(part.encode("utf-8") + b"\0")
+        # Weak, because the same ETag covers the gzip, br and identity bodies
+        return 'W/"{}"'.format(hasher.hexdigest()[:32])
+
+    def wrap(app):
+        async def http_cache(scope, receive, send):
+            if (
+                scope["type"] != "http"
+                or scope["method"] not in ("GET", "HEAD")
+                or not CACHEABLE_PATHS.match(scope["path"])
+            ):
+                await app(scope, receive, send)
+                return
+            request_headers = dict(scope.get("headers") or [])
+            # Signed-in actors could see personalized pages
+            if b"ds_actor" in request_headers.get(b"cookie", b""):
+                await app(scope, receive, send)
+                return
+            etag = etag_for(scope)
+            if etag is None:
+                await app(scope, receive, send)
+                return
+            if_none_match = request_headers.get(b"if-none-match", b"").decode("latin-1")
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            # ETags are only ever sent with a 200, so a match means the page
+            # exists. "*" matches any page that exists, which isn't known
+            # until it is found in the cache or rendered
+            if etag in tags or etag[2:] in tags:
+                await send_not_modified(send, etag)
+                return
+            any_tag = "*" in tags
+            encoding_header = request_headers.get(b"accept-encoding", b"")
+            cached = response_cache.get(etag)
+            if cached is not None and any_tag:
+                await send_not_modified(send, etag)
+                return
+            if cached is not None:
+                await send_cached(
+                    send,
+                    cached["headers"],
+                    etag,
+                    cached["bodies"],
+                    choose_encoding(
+                        encoding_header.decode("latin-1"), cached["bodies"]
+                    ),
+                    scope["method"],
+                )
+                return
+
+            # Render as a GET so HEAD requests also fill the cache
+            start = {}
+            chunks = []
+
+            async def capture(message):
+                if message["type"] == "http.response.start":
+                    start.update(message)
+                elif message["type"] == "http.response.body":
+                    chunks.append(message.get("body", b""))
+
+            await app(dict(scope, method="GET"), receive, capture)
+            headers = [
+                (name, value)
+                for name, value in start.get("headers", [])
+                if name.lower()
+                not in (b"content-length", b"cache-control", b"etag", b"vary")
+            ]
+            body = b"".join(chunks)
+            if start.get("status") != 200 or any(
+                name.lower() in (b"set-cookie", b"content-encoding")
+                for name, _ in headers
+            ):
+                await send(start)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": body if scope["method"] == "GET" else b"",
+                    }
+                )
+                return
+            bodies = compressed_bodies(body)
+            response_cache.set(etag, headers, bodies)
+            if any_tag:
+                await send_not_modified(send, etag)
+                return
+            await send_cached(
+                send,
+                headers,
+                etag,
+                bodies,
+                choose_encoding(encoding_header.decode("latin-1"), bodies),
+                scope["method"],
+            )
+
+        return http_cache
+
+    return wrap
@@ -0,0 +1,280 @@
+"""
+Per-route and per-query latency histograms, plus call counts for the
+template_vars helpers, served as JSON at /-/til-metrics to actors with
+the debug-menu permission (root, by default)
+
+Set TIL_SLOW_QUERY_MS to log queries slower than that many milliseconds.
+Their parameters - which include visitors' search terms - only go to the
+log, never to /-/til-metrics.
+"""
+
+from collections import deque
+import contextvars
+from datasette import hookimpl
+from datasette.plugins import pm
+from datasette.utils.asgi import Forbidden, Response
+import bisect
+import functools
+import inspect
+import logging
+import os
+import re
+import time
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+SLOW_QUERY_MS = (
+    float(os.environ["TIL_SLOW_QUERY_MS"])
+    if os.environ.get("TIL_SLOW_QUERY_MS")
+    else None
+)
+SLOW_QUERY_LOG_SIZE = 100
+# Stop tracking new distinct SQL strings past this point
+MAX_QUERIES = 500
+ROUTES = (
+    ("/", re.compile(r"^/$")),
+    ("/all", re.compile(r"^/all$")),
+    ("/tils/search", re.compile(r"^/tils/search(\.\w+)?$")),
+    ("/tils/feed.atom", re.compile(r"^/tils/feed\.atom$")),
+    ("/tils/feed_by_topic.atom", re.compile(r"^/tils/feed_by_topic\.atom$")),
+    ("/-/*", re.compile(r"^/-/")),
+    ("/static/*", re.compile(r"^/static/")),
+    ("/tils/*", re.compile(r"^/tils(/|$)")),
+    ("/{topic}/{slug}", re.compile(r"^/[^/]+/[^/]+$")),
+    ("/{topic}", re.compile(r"^/[^/]+$")),
+)
+HELPERS = ("first_paragraph", "related_tils")
+
+logger = logging.getLogger("til.slow_queries")
+whitespace_re = re.compile(r"\s+")
+current_route = contextvars.ContextVar("current_route", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, fraction):
+        "Upper bound of the bucket containing this percentile"
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max_ms
+        return None
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": {
+                ("<={}".format(bound) if i < len(BUCKETS_MS) else "more"): count
+                for i, (bound, count) in enumerate(
+                    zip(BUCKETS_MS + (None,), self.counts)
+                )
+                if count
+            },
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.routes = {}
+        self.queries = {}
+        self.helpers = {name: Histogram() for name in HELPERS}
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+    def route(self, name):
+        if name not in self.routes:
+            self.routes[name] = {
+                "latency": Histogram(),
+                "statuses": {},
+                "queries": 0,
+                "helper_calls": {helper: 0 for helper in HELPERS},
+            }
+        return self.routes[name]
+
+    def record_query(self, sql, params, ms):
+        key = whitespace_re.sub(" ", sql).strip()
+        histogram = self.queries.get(key)
+        if histogram is None:
+            if len(self.queries) >= MAX_QUERIES:
+                key = "(other)"
+            histogram = self.queries.setdefault(key, Histogram())
+        histogram.record(ms)
+        route = current_route.get()
+        if route is not None:
+            route["queries"] += 1
+        if SLOW_QUERY_MS is not None and ms >= SLOW_QUERY_MS:
+            self.slow_queries.append(
+                {"time": time.time(), "ms": round(ms, 3), "sql": sql}
+            )
+            logger.warning(
+                "Slow query (%.1fms): %s %s",
+                ms,
+                key,
+                {k: repr(v) for k, v in dict(params or {}).items()},
+            )
+
+    def record_helper(self, name, ms):
+        self.helpers[name].record(ms)
+        route = current_route.get()
+        if route is not None:
+            route["helper_calls"][name] += 1
+
+    def as_dict(self):
+        return {
+            "since": self.started,
+            "routes": {
+                name: {
+                    "latency": route["latency"].as_dict(),
+                    "statuses": route["statuses"],
+                    "queries_per_request": (
+                        round(route["queries"] / route["latency"].count, 3)
+                        if route["latency"].count
+                        else None
+                    ),
+                    "helper_calls_per_request": (
+                        {
+                            helper: round(calls / route["latency"].count, 3)
+                            for helper, calls in route["helper_calls"].items()
+                        }
+                        if route["latency"].count
+                        else None
+                    ),
+                }
+                for name, route in sorted(self.routes.items())
+            },
+            "queries": {
+                sql: histogram.as_dict()
+                for sql, histogram in sorted(
+                    self.queries.items(), key=lambda item: -item[1].total_ms
+                )
+            },
+            "helpers": {
+                name: histogram.as_dict() for name, histogram in self.helpers.items()
+            },
+            "slow_query_ms": SLOW_QUERY_MS,
+            "slow_queries": list(self.slow_queries),
+        }
+
+
+metrics = Metrics()
+
+
+def route_name(path):
+    for name, pattern in ROUTES:
+        if pattern.match(path):
+            return name
+    return "other"
+
+
+def time_queries(db):
+    execute = db.execute
+
+    async def timed_execute(sql, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await execute(sql, params, **kwargs)
+        finally:
+            metrics.record_query(sql, params, (time.perf_counter() - start) * 1000)
+
+    db.execute = timed_execute
+
+
+def time_helper(module, name):
+    fn = getattr(module, name, None)
+    if fn is None:
+        return
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                metrics.record_helper(name, (time.perf_counter() - start) * 1000)
+
+    else:
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.record_helper(name, (time.perf_counter() - start) * 1000)
+
+    setattr(module, name, timed)
+
+
+@hookimpl
+def startup(datasette):
+    for db in datasette.databases.values():
+        time_queries(db)
+    # template_vars.py looks these helpers up as module globals
+    for plugin in pm.get_plugins():
+        if getattr(plugin, "__name__", None) == "template_vars.py":
+            for name in HELPERS:
+                time_helper(plugin, name)
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    def wrap(app):
+        async def timed_app(scope, receive, send):
+            if scope["type"] != "http":
+                await app(scope, receive, send)
+                return
+            route = metrics.route(route_name(scope["path"]))
+            token = current_route.set(route)
+            status = None
+
+            async def wrapped_send(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                await send(message)
+
+            start = time.perf_counter()
+            try:
+                await app(scope, receive, wrapped_send)
+            finally:
+                route["latency"].record((time.perf_counter() - start) * 1000)
+                route["statuses"][str(status)] = (
+                    route["statuses"].get(str(status), 0) + 1
+                )
+                current_route.reset(token)
+
+        return timed_app
+
+    return wrap
+
+
+async def metrics_view(datasette, request):
+    if not await datasette.permission_allowed(
+        request.actor, "view-instance", default=True
+    ) or not await datasette.permission_allowed(request.actor, "debug-menu"):
+        raise Forbidden("Permission denied")
+    return Response.json(metrics.as_dict())
+
+
+@hookimpl
+def register_routes():
+    return (("^/-/til-metrics$", metrics_view),)
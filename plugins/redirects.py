@@ -1,5 +1,9 @@
 from datasette import hookimpl
-from datasette.utils.asgi import Response
+from datasette.utils.asgi import NotFound, Response
+import re
+
+# Only paths shaped like a TIL page can have moved
+til_path_re = re.compile(r"^/[^/]+/[^/]+$")
 
 
 @hookimpl
@@ -29,3 +33,34 @@ def register_routes():
             ),
         ),
     )
+
+
+async def resolve_redirect(datasette, path):
+    "Where a TIL that used to live at path lives now, via the redirects table"
+    db = datasette.databases.get("tils")
+    if db is None or not til_path_re.match(path):
+        return None
+    if "redirects" not in await db.table_names():
+        return None
+    # from_path is the primary key, so this is a single index lookup
+    row = (
+        await db.execute("select to_path from redirects where from_path = ?", [path])
+    ).first()
+    return row[0] if row else None
+
+
+@hookimpl
+def handle_exception(datasette, request, exception):
+    # Only consulted once a path has already failed to match a TIL
+    if not isinstance(exception, NotFound):
+        return None
+
+    async def inner():
+        location = await resolve_redirect(datasette, request.path)
+        if location is None:
+            return None
+        if request.query_string:
+            location += "?" + request.query_string
+        return Response.redirect(location, status=301)
+
+    return inner
@@ -1,15 +1,207 @@
+from collections import OrderedDict
 from datasette import hookimpl
-from bs4 import BeautifulSoup as Soup
+from datasette.utils.asgi import Response
+import hashlib
 import html
+import os
 import re
+import threading
+import time
 
 non_alphanumeric = re.compile(r"[^a-zA-Z0-9\s]")
 multi_spaces = re.compile(r"\s+")
+# <p> elements cannot nest, so the first </p> closes the first paragraph
+first_paragraph_re = re.compile(r"<p[\s>].*?</p>", re.DOTALL | re.IGNORECASE)
 
 
-def first_paragraph(html):
-    soup = Soup(html, "html.parser")
-    return str(soup.find("p"))
+class FirstParagraphCache:
+    """
+    Bounded LRU cache of extract_first_paragraph() results, keyed by a hash
+    of the HTML rather than the HTML itself. Also used by the SQL function,
+    which runs on Datasette's connection threads.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, html):
+        key = hashlib.sha1(html.encode("utf-8")).digest()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        match = first_paragraph_re.search(html)
+        paragraph = match.group(0) if match else ""
+        with self.lock:
+            self.entries[key] = paragraph
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return paragraph
+
+
+first_paragraph_cache = FirstParagraphCache()
+
+
+def extract_first_paragraph(html):
+    return first_paragraph_cache.get(html or "")
+
+
+def first_paragraph(til):
+    """
+    Teaser HTML for a til row, using the first_paragraph_html column that
+    build_database.py precomputes. Also accepts a string of HTML.
+    """
+    if til is None or isinstance(til, str):
+        return extract_first_paragraph(til)
+    try:
+        precomputed = til["first_paragraph_html"]
+    except (IndexError, KeyError):
+        precomputed = None
+    if precomputed is not None:
+        return precomputed
+    try:
+        return extract_first_paragraph(til["html"])
+    except (IndexError, KeyError):
+        return ""
+
+
+RELATED_SQL = """
+select
+  til.topic, til.slug, til.title, til.created
+from til
+  join similarities on til.path = similarities.other_id
+where similarities.id = :path
+order by similarities.score desc limit 10
+"""
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query results with a TTL. Keys include the
+    database version, so a rebuilt database never serves stale results.
+    Bounded by number of entries and by the approximate size of the rows.
+    """
+
+    def __init__(self, maxsize=1000, max_bytes=16 * 1024 * 1024, ttl=3600):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Hashes of keys that were missed once, for set(..., repeated_only=True)
+        self.seen = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def set(self, key, value, repeated_only=False):
+        """
+        repeated_only skips the first result for each key, so one-off keys
+        such as most search terms never take up space
+        """
+        if repeated_only:
+            seen = hash(key)
+            if seen not in self.seen:
+                self.seen[seen] = True
+                while len(self.seen) > self.maxsize:
+                    self.seen.popitem(last=False)
+                return
+            self.seen.pop(seen)
+        size = results_size(value)
+        if size > self.max_bytes:
+            return
+        self.pop(key)
+        self.entries[key] = (time.monotonic() + self.ttl, value, size)
+        self.size += size
+        while len(self.entries) > self.maxsize or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted[2]
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def results_size(results):
+    "Approximate memory used by the rows of a Datasette Results"
+    return sum(
+        64 + sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in row)
+        for row in results.rows
+    )
+
+
+query_cache = QueryCache(
+    maxsize=int(os.environ.get("TIL_QUERY_CACHE_SIZE", 1000)),
+    max_bytes=int(os.environ.get("TIL_QUERY_CACHE_BYTES", 16 * 1024 * 1024)),
+    ttl=int(os.environ.get("TIL_QUERY_CACHE_TTL", 3600)),
+)
+
+
+def database_version(db):
+    """
+    The content hash for an immutable database (as deployed), otherwise
+    the size and mtime of the file and its WAL, which change on every write.
+    Also used for ETags by http_cache.py
+    """
+    if not db.is_mutable and db.hash:
+        return db.hash
+    version = []
+    for path in (db.path, db.path + "-wal"):
+        try:
+            stat = os.stat(path)
+            version.append("{}-{}".format(stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            version.append("")
+    return ":".join(version)
+
+
+def cache_queries(db, cacheable_sql, repeated_only_sql=()):
+    """
+    Wrap db.execute() so results of the listed SQL queries are cached -
+    those in repeated_only_sql only once they have been run twice
+    """
+    execute = db.execute
+
+    async def cached_execute(sql, params=None, **kwargs):
+        if sql not in cacheable_sql and sql not in repeated_only_sql:
+            return await execute(sql, params, **kwargs)
+        key = (
+            db.name,
+            database_version(db),
+            sql,
+            tuple(sorted((name, params[name]) for name in (params or {}))),
+            tuple(sorted(kwargs.items())),
+        )
+        results = query_cache.get(key)
+        if results is None:
+            results = await execute(sql, params, **kwargs)
+            query_cache.set(key, results, repeated_only=sql in repeated_only_sql)
+        return results
+
+    db.execute = cached_execute
 
 
 def highlight(s):
@@ -18,32 +210,46 @@ def highlight(s):
     return s
 
 
+async def related_tils(datasette, til):
+    result = await datasette.get_database("tils").execute(
+        RELATED_SQL, {"path": til["path"]}
+    )
+    return result.rows
+
+
 @hookimpl
 def extra_template_vars(request, datasette):
-    async def related_tils(til):
-        path = til["path"]
-        sql = """
-        select
-          til.topic, til.slug, til.title, til.created
-        from til
-          join similarities on til.path = similarities.other_id
-        where similarities.id = :path
-        order by similarities.score desc limit 10
-        """
-        result = await datasette.get_database().execute(
-            sql,
-            {"path": til["path"]},
-        )
-        return result.rows
-
     return {
         "q": request.args.get("q", ""),
         "highlight": highlight,
         "first_paragraph": first_paragraph,
-        "related_tils": related_tils,
+        # Looked up on each call so plugins/metrics.py can time it
+        "related_tils": lambda til: related_tils(datasette, til),
     }
 
 
 @hookimpl
 def prepare_connection(conn):
     conn.create_function("first_paragraph", 1, first_paragraph)
+
+
+@hookimpl
+def startup(datasette):
+    async def inner():
+        if "tils" not in datasette.databases:
+            return
+        search = await datasette.get_canned_query("tils", "search", None)
+        # Search terms are chosen by whoever is searching - most are only
+        # ever used once, so don't let them push out the related TILs
+        cache_queries(
+            datasette.get_database("tils"),
+            {RELATED_SQL},
+            repeated_only_sql={search["sql"]} if search else (),
+        )
+
+    return inner
+
+
+@hookimpl
+def register_routes():
+    return (("^/-/til-cache$", lambda: Response.json(query_cache.stats())),)
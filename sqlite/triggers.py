@@ -2,17 +2,70 @@ import textwrap
 import sqlite3
 import json
 
+MODES = ("all", "after", "changed")
+
+
+def latest_id(db):
+    "The watermark: id of the most recent log entry, or 0"
+    return db.execute("select coalesce(max(id), 0) from log").fetchone()[0]
+
+
+def log_since(db, last_seen, limit=None):
+    "Log entries with id > last_seen - uses the primary key, not a full scan"
+    sql = (
+        "select id, trigger_name, table_name, details from log where id > ? order by id"
+    )
+    params = [last_seen]
+    if limit is not None:
+        sql += " limit ?"
+        params.append(limit)
+    return [
+        {
+            "id": id,
+            "trigger_name": trigger_name,
+            "table_name": table_name,
+            "details": details,
+        }
+        for id, trigger_name, table_name, details in db.execute(sql, params)
+    ]
+
+
+class ChangeConsumer:
+    """
+    Reads the log in batches of up to batch_size entries, starting after
+    last_seen. Persist consumer.last_seen to resume where it left off.
+    """
+
+    def __init__(self, db, last_seen=0, batch_size=100):
+        self.db = db
+        self.last_seen = last_seen
+        self.batch_size = batch_size
+
+    def poll(self):
+        "Returns the next batch (possibly empty) and advances the watermark"
+        batch = log_since(self.db, self.last_seen, self.batch_size)
+        if batch:
+            self.last_seen = batch[-1]["id"]
+        return batch
+
+    def __iter__(self):
+        # Yields batches until the log is drained
+        while True:
+            batch = self.poll()
+            if not batch:
+                return
+            yield batch
+
 
 def execute(db, sql, params=None):
-    logs_before = db.execute("select * from log").fetchall()
+    last_seen = latest_id(db)
     print(sql, params or "")
     if params is None:
         result = db.execute(sql)
     else:
         result = db.execute(sql, params)
-    logs_after = db.execute("select * from log").fetchall()
-    if len(logs_after) > len(logs_before):
-        rows = [dict(row) for row in logs_after[len(logs_before) :]]
+    rows = log_since(db, last_seen)
+    if rows:
         for row in rows:
             print(
                 f"  {row['trigger_name']} on {row['table_name']}:\n{textwrap.indent(json.dumps(json.loads(row['details']), indent=2), '    ')}"
@@ -21,9 +74,17 @@ def execute(db, sql, params=None):
     return result
 
 
-def create_triggers(db, table, pk_cols, non_pk_cols):
-    # Adds before/after triggers for all operations
+def create_triggers(db, table, pk_cols, non_pk_cols, mode="all"):
+    # mode="all" adds before/after triggers for all operations
     # which log what happened, including JSON of NEW and OLD
+    # mode="after" only adds the after triggers
+    # mode="changed" adds after triggers that log the key plus just the
+    # columns that changed, skipping updates that changed nothing
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {MODES}")
+    if mode == "changed":
+        create_changed_triggers(db, table, pk_cols, non_pk_cols)
+        return
     json_object_new = (
         "json_object("
         + ", ".join(f"'{col}', NEW.{col}" for col in pk_cols + non_pk_cols)
@@ -35,8 +96,9 @@ def create_triggers(db, table, pk_cols, non_pk_cols):
         + ")"
     )
     # before insert
-    db.execute(
-        f"""
+    if mode == "all":
+        db.execute(
+            f"""
     create trigger {table}_bi
     before insert on {table}
     for each row
@@ -44,8 +106,8 @@ def create_triggers(db, table, pk_cols, non_pk_cols):
       insert into log (trigger_name, table_name, details)
       values ('before insert', '{table}', json_object('action', 'insert', 'new', {json_object_new}));
     end;
-    """,
-    )
+        """,
+        )
     # after insert
     db.execute(
         f"""
@@ -60,8 +122,9 @@ def create_triggers(db, table, pk_cols, non_pk_cols):
     )
 
     # before update
-    db.execute(
-        f"""
+    if mode == "all":
+        db.execute(
+            f"""
     create trigger {table}_bu
     before update on {table}
     for each row
@@ -69,8 +132,8 @@ def create_triggers(db, table, pk_cols, non_pk_cols):
       insert into log (trigger_name, table_name, details)
       values ('before update', '{table}', json_object('action', 'update', 'new', {json_object_new}, 'old', {json_object_old}));
     end;
-    """,
-    )
+        """,
+        )
     # after update
     db.execute(
         f"""
@@ -84,8 +147,9 @@ def create_triggers(db, table, pk_cols, non_pk_cols):
     """,
     )
     # before delete
-    db.execute(
-        f"""
+    if mode == "all":
+        db.execute(
+            f"""
     create trigger {table}_bd
     before delete on {table}
     for each row
@@ -93,8 +157,8 @@ def create_triggers(db, table, pk_cols, non_pk_cols):
       insert into log (trigger_name, table_name, details)
       values ('before delete', '{table}', json_object('action', 'delete', 'old', {json_object_old}));
     end;
-    """,
-    )
+        """,
+        )
     # after delete
     db.execute(
         f"""
@@ -109,6 +173,69 @@ def create_triggers(db, table, pk_cols, non_pk_cols):
     )
 
 
+def create_changed_triggers(db, table, pk_cols, non_pk_cols):
+    # After triggers only, logging the key - rowid for tables without a
+    # primary key - plus the new values of just the columns that changed
+    key_cols = pk_cols or ["rowid"]
+    json_key_new = (
+        "json_object(" + ", ".join(f"'{col}', NEW.{col}" for col in key_cols) + ")"
+    )
+    json_key_old = (
+        "json_object(" + ", ".join(f"'{col}', OLD.{col}" for col in key_cols) + ")"
+    )
+    json_object_new = (
+        "json_object("
+        + ", ".join(f"'{col}', NEW.{col}" for col in pk_cols + non_pk_cols)
+        + ")"
+    )
+    changed = " or ".join(
+        f"OLD.{col} is not NEW.{col}" for col in pk_cols + non_pk_cols
+    )
+    changed_columns = (
+        "(select json_group_object(name, json(value)) from ("
+        + " union all ".join(
+            f"select '{col}' as name, json_quote(NEW.{col}) as value where OLD.{col} is not NEW.{col}"
+            for col in pk_cols + non_pk_cols
+        )
+        + "))"
+    )
+    db.execute(
+        f"""
+    create trigger {table}_ai
+    after insert on {table}
+    for each row
+    begin
+      insert into log (trigger_name, table_name, details)
+      values ('after insert', '{table}', json_object('action', 'insert', 'key', {json_key_new}, 'new', {json_object_new}));
+    end;
+    """,
+    )
+    # A primary key change logs the old key alongside the new one
+    db.execute(
+        f"""
+    create trigger {table}_au
+    after update on {table}
+    for each row
+    when {changed}
+    begin
+      insert into log (trigger_name, table_name, details)
+      values ('after update', '{table}', json_object('action', 'update', 'key', {json_key_old}, 'changed', {changed_columns}));
+    end;
+    """,
+    )
+    db.execute(
+        f"""
+    create trigger {table}_ad
+    after delete on {table}
+    for each row
+    begin
+      insert into log (trigger_name, table_name, details)
+      values ('after delete', '{table}', json_object('action', 'delete', 'key', {json_key_old}));
+    end;
+    """,
+    )
+
+
 def create_tables(db, hide_logs=False):
     # logs table
     db.execute(
@@ -121,7 +248,9 @@ def create_tables(db, hide_logs=False):
     # Three tables: a rowid table, a single pk table, a compound pk table
     method("create table no_pk (value text)")
     method("create table single_pk (id integer primary key, value text)")
-    method("create table compound_pk (id1 integer, id2 integer, value text, primary key (id1, id2))")
+    method(
+        "create table compound_pk (id1 integer, id2 integer, value text, primary key (id1, id2))"
+    )
 
 
 def main():
@@ -139,26 +268,36 @@ def main():
     )
     print("insert or ignore:\n")
     execute(
-        db, "insert or ignore into single_pk (id, value) values (?, ?)", (1, "single_pk_value_ignored")
+        db,
+        "insert or ignore into single_pk (id, value) values (?, ?)",
+        (1, "single_pk_value_ignored"),
     )
     execute(
-        db, "insert or ignore into single_pk (id, value) values (?, ?)", (2, "single_pk_value_not_ignored")
+        db,
+        "insert or ignore into single_pk (id, value) values (?, ?)",
+        (2, "single_pk_value_not_ignored"),
     )
     print("insert or replace:\n")
     execute(
-        db, "insert or replace into single_pk (id, value) values (?, ?)", (1, "single_pk_value")
+        db,
+        "insert or replace into single_pk (id, value) values (?, ?)",
+        (1, "single_pk_value"),
     )
     execute(
-        db, "insert or replace into single_pk (id, value) values (?, ?)", (1, "single_pk_value_replaced")
+        db,
+        "insert or replace into single_pk (id, value) values (?, ?)",
+        (1, "single_pk_value_replaced"),
     )
     print("insert ... on conflict set (aka upsert):\n")
     execute(
-        db, "insert into single_pk (id, value) values (?, ?) on conflict(id) do update set value=?", 
-        (1, "conflict_value", "updated_on_conflict")
+        db,
+        "insert into single_pk (id, value) values (?, ?) on conflict(id) do update set value=?",
+        (1, "conflict_value", "updated_on_conflict"),
     )
     execute(
-        db, "insert into single_pk (id, value) values (?, ?) on conflict(id) do update set value=?", 
-        (3, "new_value", "this_wont_be_used")
+        db,
+        "insert into single_pk (id, value) values (?, ?) on conflict(id) do update set value=?",
+        (3, "new_value", "this_wont_be_used"),
     )
 
     execute(
@@ -0,0 +1,124 @@
+"""
+Measures the overhead of the triggers.py logging triggers on bulk writes
+to the no_pk, single_pk and compound_pk tables, for each trigger mode:
+
+    python triggers_benchmark.py
+    python triggers_benchmark.py 100000
+
+"upsert" updates every existing row and inserts the same number of new
+rows - no_pk has no key to conflict on, so it gets a plain update of
+every row instead. Half of the upserted rows keep their existing value,
+which "changed" mode does not log.
+"""
+
+import sqlite3
+import sys
+import time
+
+import triggers
+
+SHAPES = {
+    "no_pk": ([], ["value"]),
+    "single_pk": (["id"], ["value"]),
+    "compound_pk": (["id1", "id2"], ["value"]),
+}
+
+
+def setup(shape, mode):
+    db = sqlite3.connect(":memory:")
+    triggers.create_tables(db, hide_logs=True)
+    if mode is not None:
+        pk_cols, non_pk_cols = SHAPES[shape]
+        triggers.create_triggers(db, shape, pk_cols, non_pk_cols, mode=mode)
+    return db
+
+
+def insert_rows(db, shape, start, count):
+    values = ((i, i % 7, "value {}".format(i)) for i in range(start, start + count))
+    with db:
+        if shape == "no_pk":
+            db.executemany(
+                "insert into no_pk (value) values (?)", ((v,) for _, _, v in values)
+            )
+        elif shape == "single_pk":
+            db.executemany(
+                "insert into single_pk (id, value) values (?, ?)",
+                ((i, v) for i, _, v in values),
+            )
+        else:
+            db.executemany(
+                "insert into compound_pk (id1, id2, value) values (?, ?, ?)", values
+            )
+
+
+def upsert_rows(db, shape, count):
+    # Every other row gets a new value, the rest are rewritten unchanged
+    def value(i):
+        return "value {}".format(i) if i % 2 else "updated {}".format(i)
+
+    with db:
+        if shape == "no_pk":
+            db.executemany(
+                "update no_pk set value = ? where rowid = ?",
+                ((value(i), i + 1) for i in range(count)),
+            )
+        elif shape == "single_pk":
+            db.executemany(
+                "insert into single_pk (id, value) values (?, ?) "
+                "on conflict(id) do update set value = excluded.value",
+                ((i, value(i)) for i in range(count * 2)),
+            )
+        else:
+            db.executemany(
+                "insert into compound_pk (id1, id2, value) values (?, ?, ?) "
+                "on conflict(id1, id2) do update set value = excluded.value",
+                ((i, i % 7, value(i)) for i in range(count * 2)),
+            )
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def benchmark(shape, mode, count):
+    db = setup(shape, mode)
+    insert = timed(insert_rows, db, shape, 0, count)
+    upsert = timed(upsert_rows, db, shape, count)
+    log_rows = db.execute("select count(*) from log").fetchone()[0]
+    consumer = triggers.ChangeConsumer(db, batch_size=1000)
+    drain = timed(lambda: sum(len(batch) for batch in consumer))
+    return insert, upsert, log_rows, drain
+
+
+def main(count):
+    print("{} rows\n".format(count))
+    print(
+        "{:<12} {:<8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+            "table", "mode", "insert s", "overhead", "upsert s", "log rows", "drain s"
+        )
+    )
+    for shape in SHAPES:
+        baseline = None
+        for mode in (None,) + triggers.MODES:
+            insert, upsert, log_rows, drain = benchmark(shape, mode, count)
+            total = insert + upsert
+            if baseline is None:
+                baseline = total
+            print(
+                "{:<12} {:<8} {:>10.3f} {:>9.1f}x {:>10.3f} {:>10} {:>10.3f}".format(
+                    shape,
+                    mode or "none",
+                    insert,
+                    total / baseline,
+                    upsert,
+                    log_rows,
+                    drain,
+                )
+            )
+        print()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
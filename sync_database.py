@@ -0,0 +1,493 @@
+"""
+Sync tils.db with the S3 bucket as a full snapshot plus a chain of small
+changesets, instead of moving the whole file on every build:
+
+    python sync_database.py pull            # rebuild tils.db from the bucket
+    python sync_database.py snapshot-key    # print the current snapshot's key
+    python sync_database.py push            # upload what changed since pull
+    python sync_database.py push --snapshot # upload a full snapshot instead
+
+    python sync_database.py diff base.db current.db changeset.json.gz
+    python sync_database.py apply base.db changeset.json.gz
+
+Changesets come from a row-hash diff of every ordinary table. FTS indexes are
+not synced directly - the triggers on til keep them up to date as changes
+are applied. A new snapshot is uploaded every SNAPSHOT_EVERY changesets,
+when the changesets add up to more than a quarter of the snapshot, or when
+triggers or virtual tables change. The plain tils.db at the root of the
+bucket is only refreshed along with each snapshot.
+
+pull starts from the local copy in .cache/sync_base.db when its hash is in
+the current chain, so only newer changesets are downloaded. CI caches that
+file keyed by snapshot-key.
+
+Set SYNC_BUCKET_DIR to use a directory as a stand-in for the bucket.
+"""
+
+import base64
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+root = pathlib.Path(__file__).parent.resolve()
+
+PREFIX = "sync/"
+MANIFEST = PREFIX + "manifest.json"
+SNAPSHOT_EVERY = 20
+MAX_CHANGESET_FRACTION = 0.25
+# The database as it was after the last pull or push, and its hash
+BASE_PATH = root / ".cache" / "sync_base.db"
+BASE_HASH_PATH = root / ".cache" / "sync_base.json"
+
+
+class S3Bucket:
+    "The til.simonwillison.net bucket, using s3-credentials"
+
+    def __init__(self, bucket="til.simonwillison.net"):
+        self.bucket = bucket
+
+    def get(self, key):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = pathlib.Path(tmp) / "object"
+            proc = subprocess.run(
+                ["s3-credentials", "get-object", self.bucket, key, "-o", str(output)],
+                capture_output=True,
+            )
+            if proc.returncode != 0 or not output.exists():
+                return None
+            return output.read_bytes()
+
+    def put(self, key, content, content_type="application/octet-stream"):
+        subprocess.run(
+            [
+                "s3-credentials",
+                "put-object",
+                self.bucket,
+                key,
+                "-",
+                "--content-type",
+                content_type,
+                "--silent",
+            ],
+            input=content,
+            check=True,
+        )
+
+
+class LocalBucket:
+    "A directory standing in for the bucket"
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+
+    def get(self, key):
+        path = self.directory / key
+        return path.read_bytes() if path.exists() else None
+
+    def put(self, key, content, content_type=None):
+        path = self.directory / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+
+
+def get_bucket():
+    if os.environ.get("SYNC_BUCKET_DIR"):
+        return LocalBucket(os.environ["SYNC_BUCKET_DIR"])
+    return S3Bucket()
+
+
+def schema(conn):
+    """
+    Returns (tables, virtual, other): {name: sql} for ordinary tables, for
+    virtual tables and for the triggers and everything else
+    """
+    rows = conn.execute(
+        "select type, name, sql from sqlite_master where name not like 'sqlite_%'"
+    ).fetchall()
+    virtual = {
+        name: sql
+        for type, name, sql in rows
+        if type == "table" and sql.upper().startswith("CREATE VIRTUAL TABLE")
+    }
+    tables = {
+        name: sql
+        for type, name, sql in rows
+        if type == "table" and name not in virtual
+        # Shadow tables belonging to an FTS table
+        and not any(name.startswith(v + "_") for v in virtual)
+    }
+    other = {
+        "{} {}".format(type, name): sql
+        for type, name, sql in rows
+        if type != "table" and sql is not None
+    }
+    return tables, virtual, other
+
+
+def key_columns(conn, table):
+    pks = [
+        row[1]
+        for row in sorted(
+            conn.execute("pragma table_info([{}])".format(table)), key=lambda r: r[5]
+        )
+        if row[5]
+    ]
+    return pks or ["rowid"]
+
+
+def encode(value):
+    if isinstance(value, bytes):
+        return {"$base64": base64.b64encode(value).decode("ascii")}
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value["$base64"])
+    return value
+
+
+def select_rows(conn, table, limit=None):
+    keys = key_columns(conn, table)
+    select = "rowid, *" if keys == ["rowid"] else "*"
+    sql = "select {} from [{}]".format(select, table)
+    if limit is not None:
+        sql += " limit {}".format(limit)
+    return keys, conn.execute(sql)
+
+
+def table_columns(conn, table):
+    "The columns in each row from table_rows(), even if the table is empty"
+    _, cursor = select_rows(conn, table, limit=0)
+    return [d[0] for d in cursor.description]
+
+
+def table_rows(conn, table):
+    "Yields (key, columns, row) for every row, keyed by primary key or rowid"
+    keys, cursor = select_rows(conn, table)
+    columns = [d[0] for d in cursor.description]
+    indexes = [columns.index(key) for key in keys]
+    for row in cursor:
+        yield tuple(row[i] for i in indexes), columns, row
+
+
+def row_hash(row):
+    return hashlib.md5(
+        json.dumps([encode(value) for value in row]).encode("utf-8")
+    ).hexdigest()
+
+
+def row_hashes(conn, table):
+    return {key: row_hash(row) for key, _, row in table_rows(conn, table)}
+
+
+def database_hash(conn):
+    "Hash of the schema and every row of every synced table"
+    tables, virtual, other = schema(conn)
+    hasher = hashlib.sha256()
+    for name, sql in sorted({**tables, **virtual, **other}.items()):
+        hasher.update("{}\0{}\0".format(name, sql).encode("utf-8"))
+    for table in sorted(tables):
+        for key, value in sorted(row_hashes(conn, table).items(), key=repr):
+            hasher.update("{}\0{}\0".format(repr(key), value).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def make_changeset(base, current):
+    """
+    Returns a changeset turning the base connection into current, or None if
+    triggers or virtual tables changed and a snapshot is needed instead
+    """
+    base_tables, base_virtual, base_other = schema(base)
+    tables, virtual, other = schema(current)
+    triggers = {name for name in {**base_other, **other} if name.startswith("trigger")}
+    if base_virtual != virtual or any(
+        base_other.get(name) != other.get(name) for name in triggers
+    ):
+        return None
+    altered = [
+        table
+        for table, sql in tables.items()
+        if table in base_tables and base_tables[table] != sql
+    ]
+    # Dropping an altered table also drops its indexes and triggers
+    dependents = {
+        "{} {}".format(type, name)
+        for type, name in current.execute(
+            "select type, name from sqlite_master where tbl_name in ({}) "
+            "and type != 'table' and sql is not null".format(
+                ", ".join("?" for _ in altered)
+            ),
+            altered,
+        )
+    }
+    if dependents & triggers:
+        return None
+    changes = []
+    for table, sql in tables.items():
+        if base_tables.get(table) != sql:
+            # New or altered table - send it whole
+            rows = list(table_rows(current, table))
+            changes.append(
+                {
+                    "table": table,
+                    "create": sql,
+                    "keys": key_columns(current, table),
+                    "columns": table_columns(current, table),
+                    "upserts": [[encode(v) for v in row] for _, _, row in rows],
+                    "deletes": [],
+                }
+            )
+            continue
+        before = row_hashes(base, table)
+        upserts = []
+        for key, _, row in table_rows(current, table):
+            if before.pop(key, None) != row_hash(row):
+                upserts.append([encode(v) for v in row])
+        if upserts or before:
+            changes.append(
+                {
+                    "table": table,
+                    "keys": key_columns(current, table),
+                    "columns": table_columns(current, table),
+                    "upserts": upserts,
+                    "deletes": [[encode(v) for v in key] for key in before],
+                }
+            )
+    return {
+        "base_hash": database_hash(base),
+        "hash": database_hash(current),
+        "drop_tables": sorted(set(base_tables) - set(tables)),
+        "drop_other": sorted(
+            name
+            for name in base_other
+            if name not in triggers
+            and (base_other[name] != other.get(name) or name in dependents)
+        ),
+        "create_other": {
+            name: sql
+            for name, sql in other.items()
+            if name not in triggers
+            and (base_other.get(name) != sql or name in dependents)
+        },
+        "tables": changes,
+    }
+
+
+def apply_changeset(conn, changeset):
+    "Apply a changeset in a single transaction, checking the resulting hash"
+    if database_hash(conn) != changeset["base_hash"]:
+        raise ValueError("Changeset does not apply to this database")
+    with conn:
+        for name in changeset["drop_other"]:
+            type, _, object_name = name.partition(" ")
+            conn.execute("drop {} if exists [{}]".format(type, object_name))
+        for table in changeset["drop_tables"]:
+            conn.execute("drop table [{}]".format(table))
+        for change in changeset["tables"]:
+            table = change["table"]
+            if "create" in change:
+                conn.execute("drop table if exists [{}]".format(table))
+                conn.execute(change["create"])
+            keys = change["keys"]
+            where = " and ".join("[{}] = ?".format(key) for key in keys)
+            for key in change["deletes"]:
+                conn.execute(
+                    "delete from [{}] where {}".format(table, where),
+                    [decode(v) for v in key],
+                )
+            columns = change["columns"]
+            key_indexes = [columns.index(key) for key in keys]
+            # Update-then-insert rather than REPLACE, so the FTS triggers fire
+            update_sql = "update [{}] set {} where {}".format(
+                table,
+                ", ".join("[{}] = ?".format(c) for c in columns if c != "rowid"),
+                where,
+            )
+            insert_sql = "insert into [{}] ({}) values ({})".format(
+                table,
+                ", ".join("[{}]".format(c) for c in columns),
+                ", ".join("?" for _ in columns),
+            )
+            for row in change["upserts"]:
+                row = [decode(v) for v in row]
+                values = [v for c, v in zip(columns, row) if c != "rowid"]
+                cursor = conn.execute(
+                    update_sql, values + [row[i] for i in key_indexes]
+                )
+                if cursor.rowcount == 0:
+                    conn.execute(insert_sql, row)
+        for sql in changeset["create_other"].values():
+            conn.execute(sql)
+    if database_hash(conn) != changeset["hash"]:
+        raise ValueError("Database hash does not match after applying changeset")
+
+
+def copy_database(source, destination):
+    destination = pathlib.Path(destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    destination.unlink(missing_ok=True)
+    src = sqlite3.connect(str(source))
+    dst = sqlite3.connect(str(destination))
+    with dst:
+        src.backup(dst)
+    src.close()
+    dst.close()
+
+
+def save_base(db_path, db_hash):
+    copy_database(db_path, BASE_PATH)
+    BASE_HASH_PATH.write_text(json.dumps({"hash": db_hash}))
+
+
+def base_hash():
+    "Hash recorded for BASE_PATH, or None if there is no usable base"
+    if not BASE_PATH.exists() or not BASE_HASH_PATH.exists():
+        return None
+    return json.loads(BASE_HASH_PATH.read_text()).get("hash")
+
+
+def get_manifest(bucket):
+    manifest = bucket.get(MANIFEST)
+    return json.loads(manifest) if manifest else None
+
+
+def pull(db_path, bucket):
+    """
+    Rebuild db_path from the latest snapshot and changesets, starting from
+    the local base instead of the snapshot if it is part of the chain
+    """
+    manifest = get_manifest(bucket)
+    if manifest is None:
+        print("No snapshot in the bucket yet")
+        return False
+    snapshot = manifest["snapshot"]
+    chain = manifest["changesets"]
+    hashes = [snapshot["hash"]] + [entry["hash"] for entry in chain]
+    local_hash = base_hash()
+    downloaded = 0
+    if local_hash in hashes:
+        copy_database(BASE_PATH, db_path)
+        changesets = chain[hashes.index(local_hash) :]
+        source = "local base"
+    else:
+        content = bucket.get(snapshot["key"])
+        pathlib.Path(db_path).write_bytes(gzip.decompress(content))
+        downloaded += len(content)
+        changesets = chain
+        source = "snapshot"
+    conn = sqlite3.connect(str(db_path))
+    try:
+        for entry in changesets:
+            content = bucket.get(entry["key"])
+            downloaded += len(content)
+            apply_changeset(conn, json.loads(gzip.decompress(content)))
+    except ValueError:
+        conn.close()
+        if source == "snapshot":
+            raise
+        # The local base was not what its recorded hash said
+        BASE_HASH_PATH.unlink()
+        return pull(db_path, bucket)
+    conn.close()
+    save_base(db_path, hashes[-1])
+    print(
+        "Pulled {} and {} changesets, {} bytes".format(
+            source, len(changesets), downloaded
+        )
+    )
+    return True
+
+
+def push_snapshot(db_path, bucket, conn):
+    content = gzip.compress(pathlib.Path(db_path).read_bytes())
+    key = "{}snapshot-{}.db.gz".format(PREFIX, int(time.time()))
+    bucket.put(key, content, "application/gzip")
+    # Also keep the plain tils.db at the root of the bucket current
+    bucket.put("tils.db", pathlib.Path(db_path).read_bytes())
+    manifest = {
+        "snapshot": {"key": key, "hash": database_hash(conn), "bytes": len(content)},
+        "changesets": [],
+    }
+    bucket.put(MANIFEST, json.dumps(manifest, indent=2).encode("utf-8"))
+    print("Pushed snapshot, {} bytes".format(len(content)))
+    return manifest["snapshot"]["hash"]
+
+
+def push(db_path, bucket, snapshot=False):
+    conn = sqlite3.connect(str(db_path))
+    manifest = get_manifest(bucket)
+    changeset = None
+    if manifest and not snapshot and BASE_PATH.exists():
+        base = sqlite3.connect(str(BASE_PATH))
+        changeset = make_changeset(base, conn)
+        base.close()
+    if changeset is not None:
+        chain = manifest["changesets"]
+        head = chain[-1]["hash"] if chain else manifest["snapshot"]["hash"]
+        if changeset["base_hash"] != head:
+            print("Bucket has changed since the last pull")
+            changeset = None
+    if changeset is None:
+        pushed_hash = push_snapshot(db_path, bucket, conn)
+    elif changeset["base_hash"] == changeset["hash"]:
+        pushed_hash = changeset["hash"]
+        print("No changes to push")
+    else:
+        pushed_hash = changeset["hash"]
+        content = gzip.compress(json.dumps(changeset).encode("utf-8"))
+        total = sum(entry["bytes"] for entry in chain) + len(content)
+        if (
+            len(chain) + 1 >= SNAPSHOT_EVERY
+            or total > MAX_CHANGESET_FRACTION * manifest["snapshot"]["bytes"]
+        ):
+            pushed_hash = push_snapshot(db_path, bucket, conn)
+        else:
+            key = "{}changeset-{}.json.gz".format(PREFIX, int(time.time() * 1000))
+            bucket.put(key, content, "application/gzip")
+            chain.append({"key": key, "hash": changeset["hash"], "bytes": len(content)})
+            bucket.put(MANIFEST, json.dumps(manifest, indent=2).encode("utf-8"))
+            print(
+                "Pushed changeset: {} rows changed, {} deleted, {} bytes".format(
+                    sum(len(t["upserts"]) for t in changeset["tables"]),
+                    sum(len(t["deletes"]) for t in changeset["tables"]),
+                    len(content),
+                )
+            )
+    conn.close()
+    save_base(db_path, pushed_hash)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    command = args[0] if args else None
+    db_path = root / "tils.db"
+    if command == "pull":
+        sys.exit(0 if pull(db_path, get_bucket()) else 1)
+    elif command == "snapshot-key":
+        manifest = get_manifest(get_bucket())
+        print(manifest["snapshot"]["key"] if manifest else "")
+    elif command == "push":
+        push(db_path, get_bucket(), snapshot="--snapshot" in args)
+    elif command == "diff":
+        base, current = sqlite3.connect(args[1]), sqlite3.connect(args[2])
+        changeset = make_changeset(base, current)
+        if changeset is None:
+            sys.exit("Triggers or virtual tables changed - a snapshot is needed")
+        pathlib.Path(args[3]).write_bytes(
+            gzip.compress(json.dumps(changeset).encode("utf-8"))
+        )
+    elif command == "apply":
+        apply_changeset(
+            sqlite3.connect(args[1]),
+            json.loads(gzip.decompress(pathlib.Path(args[2]).read_bytes())),
+        )
+    else:
+        sys.exit(__doc__)
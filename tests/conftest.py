@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# The build scripts are top-level modules in the root of the repo
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
@@ -0,0 +1,93 @@
+import pytest
+import re
+import sqlite_utils
+import subprocess
+
+import build_database
+
+write_re = re.compile(r'\s*(insert|update|delete)\b[^"]*"(til|build_manifest)"', re.I)
+
+
+def git(repo, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=Test", "-c", "user.email=test@example.com", *args],
+        cwd=repo,
+        check=True,
+        capture_output=True,
+    )
+
+
+def write_til(repo, path, title):
+    filepath = repo / path
+    filepath.parent.mkdir(exist_ok=True)
+    filepath.write_text("# {}\n\nAll about {}.\n".format(title, title.lower()))
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.setenv("MARKDOWN_BACKEND", "local")
+    monkeypatch.setenv("RENDER_CACHE_DB", str(tmp_path / "render_cache.db"))
+    repo = tmp_path / "til"
+    repo.mkdir()
+    git(repo, "init", "-q")
+    for i in range(5):
+        write_til(repo, "topic/til-{}.md".format(i), "TIL {}".format(i))
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "Five TILs")
+    return repo
+
+
+@pytest.fixture
+def statements(monkeypatch):
+    "Every SQL statement run against a tils.db while the test runs"
+    statements = []
+
+    class TracedDatabase(sqlite_utils.Database):
+        def __init__(self, path, *args, **kwargs):
+            super().__init__(path, *args, **kwargs)
+            if str(path).endswith("tils.db"):
+                self.conn.set_trace_callback(statements.append)
+
+    monkeypatch.setattr(sqlite_utils, "Database", TracedDatabase)
+    return statements
+
+
+def test_files_are_written_in_one_transaction(repo, statements, monkeypatch):
+    build_database.build_database(repo, workers=1)
+    (repo / "topic" / "til-0.md").unlink()
+    write_til(repo, "topic/til-1.md", "Changed")
+    write_til(repo, "topic/til-5.md", "New")
+    # One chunk per file, so every chunk has to share the transaction
+    monkeypatch.setattr(build_database, "CHUNK_SIZE", 1)
+    statements.clear()
+    result = build_database.build_database(repo, workers=1)
+    assert sorted(result["changed"]) == ["topic_til-1.md", "topic_til-5.md"]
+    assert result["deleted"] == ["topic_til-0.md"]
+    writes = [i for i, sql in enumerate(statements) if write_re.match(sql)]
+    assert writes
+    between = statements[writes[0] : writes[-1] + 1]
+    assert not [sql for sql in between if sql.strip().upper() in ("COMMIT", "BEGIN")]
+
+
+def test_interrupted_build_writes_no_chunks(repo, monkeypatch):
+    monkeypatch.setattr(build_database, "CHUNK_SIZE", 2)
+    summarize = build_database.summarize
+    calls = []
+
+    def fail_on_third_chunk(htmls):
+        calls.append(htmls)
+        if len(calls) == 3:
+            raise RuntimeError("Interrupted")
+        return summarize(htmls)
+
+    monkeypatch.setattr(build_database, "summarize", fail_on_third_chunk)
+    with pytest.raises(RuntimeError):
+        build_database.build_database(repo, workers=1)
+    db = sqlite_utils.Database(repo / "tils.db")
+    # The first two chunks were rolled back along with the third
+    assert not db["til"].exists() or db["til"].count == 0
+    assert not db["build_manifest"].exists() or db["build_manifest"].count == 0
+    monkeypatch.setattr(build_database, "summarize", summarize)
+    result = build_database.build_database(repo, workers=1)
+    assert len(result["changed"]) == 5
+    assert db["til"].count == db["build_manifest"].count == 5
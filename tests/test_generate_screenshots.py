@@ -0,0 +1,64 @@
+import asyncio
+import sqlite_utils
+import threading
+import time
+
+import generate_screenshots
+
+
+class Counter:
+    "Tracks how many callers are inside it at once"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = self.max = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.max = max(self.max, self.current)
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.current -= 1
+
+
+def test_uploads_do_not_hold_capture_slots(tmp_path, monkeypatch):
+    captures, uploads = Counter(), Counter()
+
+    class FakeEngine:
+        def __init__(self, root, workers):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc_info):
+            pass
+
+        async def jpeg_for_path(self, path):
+            with captures:
+                await asyncio.sleep(0.01)
+            return b"jpeg"
+
+    class SlowStorage:
+        def put(self, filename, content):
+            with uploads:
+                time.sleep(0.1)
+
+    monkeypatch.setattr(generate_screenshots, "ScreenshotEngine", FakeEngine)
+    db = sqlite_utils.Database(tmp_path / "tils.db")
+    rows = [{"path": "t_{}.md".format(i), "topic": "t", "slug": i} for i in range(32)]
+    db["til"].insert_all(rows, pk="path")
+    asyncio.run(
+        generate_screenshots.take_screenshots(
+            tmp_path,
+            db,
+            SlowStorage(),
+            [(row, "hash{}".format(i)) for i, row in enumerate(rows)],
+            workers=2,
+        )
+    )
+    assert captures.max == 2
+    assert uploads.max == generate_screenshots.UPLOAD_WORKERS
+    assert db["shots"].count == 32
@@ -0,0 +1,39 @@
+import asyncio
+import pathlib
+import pytest
+import sys
+
+root = pathlib.Path(__file__).parent.parent
+sys.path.insert(0, str(root / "benchmarks"))
+
+import load
+
+
+@pytest.fixture(scope="module")
+def get(tmp_path_factory):
+    db_path = tmp_path_factory.mktemp("http_cache") / "tils.db"
+    load.synthetic_database(db_path, 5)
+    datasette = load.make_datasette(db_path)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(datasette.invoke_startup())
+
+    def get(path, **headers):
+        return loop.run_until_complete(datasette.client.get(path, headers=headers))
+
+    yield get
+    loop.close()
+
+
+@pytest.mark.parametrize("path", ("/topic0/til-0", "/"))
+def test_etag_match_is_not_modified(get, path):
+    etag = get(path).headers["etag"]
+    response = get(path, **{"if-none-match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+
+def test_if_none_match_any_only_for_pages_that_exist(get):
+    # Twice, so the second comes from the response cache
+    for _ in range(2):
+        assert get("/topic1/til-1", **{"if-none-match": "*"}).status_code == 304
+        assert get("/topic0/missing", **{"if-none-match": "*"}).status_code == 404
@@ -0,0 +1,64 @@
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+import build_database
+import markdown_render
+
+root = pathlib.Path(__file__).parent.parent
+# Markdown from real TILs, with the summary of the HTML the GitHub API
+# rendered for it - including the cases where the backends used to differ
+fixtures = json.loads(
+    (root / "tests" / "fixtures" / "github_summaries.json").read_text()
+)
+
+
+def summary(html):
+    return build_database.first_paragraph_html_and_text(html)[1]
+
+
+@pytest.fixture(scope="module")
+def local_backend():
+    return markdown_render.LocalBackend()
+
+
+@pytest.mark.parametrize("path", sorted(fixtures))
+def test_local_summary_matches_github(local_backend, path):
+    rendered = local_backend.render_batch({path: fixtures[path]["markdown"]})[path]
+    assert summary(rendered) == fixtures[path]["github_summary"]
+
+
+@pytest.mark.skipif(
+    not (root / "tils.db").exists(), reason="needs tils.db from build_database.py"
+)
+def test_local_summaries_match_github_for_all_tils(local_backend):
+    db = sqlite_utils.Database(root / "tils.db")
+    rows = list(db.query("select path, body, html from til"))
+    rendered = local_backend.render_batch({row["path"]: row["body"] for row in rows})
+    mismatched = [
+        row["path"]
+        for row in rows
+        if summary(rendered[row["path"]]) != summary(row["html"])
+    ]
+    assert mismatched == []
+
+
+@pytest.mark.parametrize(
+    "markdown,expected",
+    (
+        ("From \\@someone", "<p>From \\@someone</p>\n"),
+        ("Not \\*emphasis\\*", "<p>Not *emphasis*</p>\n"),
+        ("Run:\n```bash\nls\n```", "<p>Run:\n<code>bash\nls</code></p>\n"),
+        (
+            "Run:\n\n```bash\nls\n```",
+            '<p>Run:</p>\n<pre><code class="language-bash">ls\n</code></pre>\n',
+        ),
+        (
+            "setup.py and https://example.com/",
+            '<p>setup.py and <a href="https://example.com/">https://example.com/</a></p>\n',
+        ),
+    ),
+)
+def test_local_backend_github_quirks(local_backend, markdown, expected):
+    assert local_backend.render_batch({"key": markdown})["key"] == expected
@@ -0,0 +1,74 @@
+import pytest
+import sqlite_utils
+
+import pipeline
+
+
+def make_stages(calls, til_changes, fail):
+    "database -> similarities -> vacuum, recording what each stage is passed"
+
+    def stage_fn(name, outputs):
+        def fn(root, changes, options):
+            calls.append((name, changes))
+            if name in fail:
+                raise RuntimeError("{} failed".format(name))
+            return outputs
+
+        return fn
+
+    return [
+        pipeline.Stage(
+            "database",
+            stage_fn("database", {"til": til_changes}),
+            inputs=[pipeline.ALWAYS],
+            outputs=["til"],
+        ),
+        pipeline.Stage(
+            "similarities",
+            stage_fn("similarities", {"similarities": {"a.md"}}),
+            inputs=["til"],
+            outputs=["similarities"],
+        ),
+        pipeline.Stage(
+            "vacuum",
+            stage_fn("vacuum", {}),
+            inputs=["til", "similarities"],
+            outputs=[],
+        ),
+    ]
+
+
+def test_failed_stage_gets_its_changes_next_run(tmp_path):
+    state = sqlite_utils.Database(memory=True).table("build_state", pk="key")
+    calls = []
+
+    def run(til_changes, fail=()):
+        unprocessed = pipeline.load_unprocessed(state)
+        try:
+            pipeline.run_pipeline(
+                tmp_path,
+                stages=make_stages(calls, til_changes, fail),
+                unprocessed=unprocessed,
+            )
+        finally:
+            pipeline.save_unprocessed(state, unprocessed)
+
+    with pytest.raises(RuntimeError):
+        run({"a.md"}, fail={"similarities"})
+    assert [name for name, _ in calls] == ["database", "similarities"]
+
+    # database.py has already recorded a.md, so reports nothing changed -
+    # similarities and vacuum still need to see it
+    calls.clear()
+    run(set())
+    assert calls == [
+        ("database", {pipeline.ALWAYS: {pipeline.ALWAYS}}),
+        ("similarities", {"til": {"a.md"}}),
+        ("vacuum", {"til": {"a.md"}, "similarities": {"a.md"}}),
+    ]
+
+    # Everything has caught up, so the next run is a no-op
+    calls.clear()
+    run(set())
+    assert [name for name, _ in calls] == ["database"]
+    assert pipeline.load_unprocessed(state) == {}
@@ -0,0 +1,82 @@
+import httpx
+import time
+
+import markdown_render
+
+
+def stand_in(responses):
+    """
+    A transport standing in for the GitHub Markdown API: returns each of
+    responses in turn (status, headers), then 200s from then on
+    """
+    requests = []
+
+    def handler(request):
+        requests.append(time.time())
+        if len(requests) <= len(responses):
+            status, headers = responses[len(requests) - 1]
+            return httpx.Response(status, headers=headers, text="rate limited")
+        return httpx.Response(200, text="<p>Rendered</p>")
+
+    return httpx.MockTransport(handler), requests
+
+
+def render(transport, texts):
+    renderer = markdown_render.Renderer(
+        url="http://stand-in/markdown", transport=transport
+    )
+    try:
+        start = time.perf_counter()
+        return renderer.render_batch(texts), time.perf_counter() - start
+    finally:
+        renderer.close()
+
+
+def test_retry_delay_uses_headers():
+    response = httpx.Response(429, headers={"retry-after": "7"})
+    assert markdown_render.retry_delay(response, 0) == 7
+    response = httpx.Response(
+        403, headers={"x-ratelimit-remaining": "0", "x-ratelimit-reset": "1010"}
+    )
+    assert markdown_render.retry_delay(response, 0, now=1000) == 11
+    # No headers - exponential backoff
+    assert markdown_render.retry_delay(httpx.Response(502), 3) == 8
+
+
+def test_retry_after_429_then_succeeds():
+    transport, requests = stand_in([(429, {"retry-after": "1"})])
+    rendered, elapsed = render(transport, {"a": "Hello"})
+    assert rendered == {"a": "<p>Rendered</p>"}
+    assert len(requests) == 2
+    assert requests[1] - requests[0] >= 1
+    assert elapsed < 3
+
+
+def test_403_waits_for_rate_limit_reset_and_pauses_everything():
+    reset = int(time.time()) + 1
+    transport, requests = stand_in(
+        [(403, {"x-ratelimit-remaining": "0", "x-ratelimit-reset": str(reset)})]
+    )
+    rendered, _ = render(transport, {"a": "One", "b": "Two", "c": "Three"})
+    assert set(rendered.values()) == {"<p>Rendered</p>"}
+    # Every request after the 403 waited for the reset, not just the retry
+    assert all(t >= reset + 1 for t in requests[1:])
+
+
+def test_rate_limit_carries_over_to_the_next_batch():
+    reset = int(time.time()) + 1
+    limited = {"x-ratelimit-remaining": "0", "x-ratelimit-reset": str(reset)}
+
+    def handler(request):
+        return httpx.Response(200, headers=limited, text="<p>Rendered</p>")
+
+    renderer = markdown_render.Renderer(
+        url="http://stand-in/markdown", transport=httpx.MockTransport(handler)
+    )
+    try:
+        renderer.render_batch({"a": "One"})
+        # build_database.py renders one batch per chunk of files
+        renderer.render_batch({"b": "Two"})
+        assert time.time() >= reset + 1
+    finally:
+        renderer.close()
@@ -0,0 +1,55 @@
+import pytest
+import sqlite3
+
+import sync_database
+
+
+@pytest.fixture
+def base():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript("""
+        create table til (path text primary key, title text);
+        insert into til values ('a.md', 'A'), ('b.md', 'B');
+        create table notes (value text);
+        insert into notes values ('one');
+        """)
+    return conn
+
+
+def copy(conn):
+    copied = sqlite3.connect(":memory:")
+    conn.backup(copied)
+    return copied
+
+
+def round_trip(base, current):
+    changeset = sync_database.make_changeset(base, current)
+    assert changeset is not None
+    sync_database.apply_changeset(base, changeset)
+    assert sync_database.database_hash(base) == sync_database.database_hash(current)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    (
+        # New empty table, like redirects when nothing has been renamed
+        "create table redirects (from_path text primary key, to_path text)",
+        # Altered and emptied
+        "delete from til; alter table til add column summary text",
+        # Emptied, schema unchanged
+        "delete from til; delete from notes",
+        "update til set title = 'Changed' where path = 'a.md'",
+    ),
+)
+def test_changeset_round_trip(base, sql):
+    current = copy(base)
+    current.executescript(sql)
+    round_trip(base, current)
+
+
+def test_empty_new_table_then_rows(base):
+    current = copy(base)
+    current.execute("create table redirects (from_path text primary key, to_path text)")
+    round_trip(base, current)
+    current.execute("insert into redirects values ('/old', '/new')")
+    round_trip(base, current)
@@ -0,0 +1,67 @@
+import asyncio
+from datasette.app import Datasette
+from datasette.plugins import pm
+import pathlib
+import pytest
+
+root = pathlib.Path(__file__).parent.parent
+
+
+@pytest.fixture(scope="module")
+def template_vars():
+    Datasette([], plugins_dir=str(root / "plugins"))
+    return next(
+        plugin
+        for plugin in pm.get_plugins()
+        if getattr(plugin, "__name__", None) == "template_vars.py"
+    )
+
+
+class Results:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+def test_bounded_by_bytes(template_vars):
+    cache = template_vars.QueryCache(maxsize=100, max_bytes=10_000)
+    for i in range(10):
+        cache.set(i, Results([("x" * 1000,)] * 2))
+    assert cache.size <= 10_000
+    assert 0 < len(cache.entries) < 10
+    # Oldest evicted first
+    assert cache.get(0) is None and cache.get(9) is not None
+    # Too big to ever fit
+    cache.set("big", Results([("x" * 20_000,)]))
+    assert cache.get("big") is None
+
+
+def test_repeated_only_skips_one_off_keys(template_vars):
+    cache = template_vars.QueryCache()
+    results = Results([("row",)])
+    cache.set("once", results, repeated_only=True)
+    assert cache.get("once") is None
+    cache.set("once", results, repeated_only=True)
+    assert cache.get("once") is results
+
+
+def test_startup_without_tils_database():
+    datasette = Datasette(memory=True, plugins_dir=str(root / "plugins"))
+
+    async def run():
+        await datasette.invoke_startup()
+        return await datasette.client.get("/-/til-cache")
+
+    assert asyncio.run(run()).status_code == 200
+
+
+def test_first_paragraph_cache_is_bounded_and_keyed_by_hash(template_vars):
+    cache = template_vars.FirstParagraphCache(maxsize=2)
+    htmls = ["<p>Para {}</p><p>Second</p>".format(i) for i in range(3)]
+    assert [cache.get(html) for html in htmls] == [
+        "<p>Para 0</p>",
+        "<p>Para 1</p>",
+        "<p>Para 2</p>",
+    ]
+    assert len(cache.entries) == 2
+    assert all(len(key) == 20 for key in cache.entries)
+    assert cache.get("No paragraphs") == ""
@@ -1,4 +1,6 @@
 "Run this after build_database.py - it needs tils.db"
+
+import instrument
 import pathlib
 import sqlite_utils
 import sys
@@ -11,8 +13,8 @@ count_re = re.compile(r"<!\-\- count starts \-\->.*<!\-\- count ends \-\->", re.
 
 COUNT_TEMPLATE = "<!-- count starts -->{}<!-- count ends -->"
 
-if __name__ == "__main__":
-    db = sqlite_utils.Database(root / "tils.db")
+
+def build_index(db):
     by_topic = {}
     for row in db["til"].rows_where(order_by="created_utc"):
         by_topic.setdefault(row["topic"], []).append(row)
@@ -29,12 +31,26 @@ if __name__ == "__main__":
     if index[-1] == "":
         index.pop()
     index.append("<!-- index ends -->")
+    return index
+
+
+def rewrite_readme(db, readme):
+    "Returns True if the README changed"
+    index_txt = "\n".join(build_index(db)).strip()
+    readme_contents = readme.open().read()
+    rewritten = index_re.sub(index_txt, readme_contents)
+    rewritten = count_re.sub(COUNT_TEMPLATE.format(db["til"].count), rewritten)
+    if rewritten == readme_contents:
+        return False
+    readme.open("w").write(rewritten)
+    return True
+
+
+if __name__ == "__main__":
+    db = sqlite_utils.Database(root / "tils.db")
     if "--rewrite" in sys.argv:
-        readme = root / "README.md"
-        index_txt = "\n".join(index).strip()
-        readme_contents = readme.open().read()
-        rewritten = index_re.sub(index_txt, readme_contents)
-        rewritten = count_re.sub(COUNT_TEMPLATE.format(db["til"].count), rewritten)
-        readme.open("w").write(rewritten)
+        with instrument.build_run("update_readme", root / "tils.db"):
+            with instrument.stage("readme"):
+                rewrite_readme(db, root / "README.md")
     else:
-        print("\n".join(index))
+        print("\n".join(build_index(db)))